@@ -1,137 +1,620 @@
+import os
+import sys
 import zlib
+import array
 import struct
+import mmap
+import tempfile
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+
+CHAR = struct.Struct('<c')
+BYTE = struct.Struct('<b')
+UNSIGNED_BYTE = struct.Struct('<B')
+SHORT = struct.Struct('<h')
+UNSIGNED_SHORT = struct.Struct('<H')
+INT = struct.Struct('<i')
+UNSIGNED_INT = struct.Struct('<I')
+LONG = struct.Struct('<l')
+UNSIGNED_LONG = struct.Struct('<L')
+FLOAT = struct.Struct('<f')
+DOUBLE = struct.Struct('<d')
+
+# How much compressed input is fed to zlib at a time, and the most output it may hand back per step.
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+# zlib's own default level, which is what zlib.compress() uses when it isn't given one. 1 is fastest, 9 is smallest.
+DEFAULT_COMPRESSION_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+# The most a SectionCache holds on disk by default, in bytes of compressed data.
+SECTION_CACHE_CAPACITY = 256 * 1024 * 1024
+SECTION_CACHE_SUFFIX = '.z'
+
+# How many threads compressAll() and decompressAll() spread their work across. zlib lets go of the GIL while it works,
+# so separate sections really do get (de)compressed at the same time. Change it with setCompressionThreads().
+try:
+    COMPRESSION_THREADS = multiprocessing.cpu_count()
+except NotImplementedError:
+    COMPRESSION_THREADS = 1
+# Started the first time it's needed, so forked processes don't inherit a pool whose threads they don't have.
+compressionPool = None
+
+def setCompressionThreads(count):
+    global COMPRESSION_THREADS, compressionPool
+    if count != COMPRESSION_THREADS and compressionPool is not None:
+        compressionPool.close()
+        compressionPool = None
+    COMPRESSION_THREADS = max(count, 1)
+
+def parallelMap(function, items):
+    # Like map(), but spread across the compression threads. Results are always in the same order as the items.
+    global compressionPool
+    items = list(items)
+    if COMPRESSION_THREADS <= 1 or len(items) <= 1:
+        return map(function, items)
+    if compressionPool is None:
+        compressionPool = multiprocessing.pool.ThreadPool(COMPRESSION_THREADS)
+    return compressionPool.map(function, items, 1)
+
+def compress(data, level=DEFAULT_COMPRESSION_LEVEL):
+    return zlib.compress(data, level)
+
+def gzipCompress(data, level=DEFAULT_COMPRESSION_LEVEL):
+    # The same deflate stream, but with a gzip header and trailer instead of zlib's. (The header has no timestamp,
+    # so the output is the same every time.)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzipDecompress(data):
+    try:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise FormatException('Compressed data is corrupt: ' + str(e))
+
+def compressAll(blobs, level=DEFAULT_COMPRESSION_LEVEL, cache=None):
+    # compress() every blob. The output is exactly what compressing them one at a time gives.
+    # With a SectionCache, blobs that were compressed before are taken from it, and only the rest get compressed.
+    if cache is None:
+        return parallelMap(lambda blob: compress(blob, level), blobs)
+    keys = [cache.getKey(blob, level) for blob in blobs]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    for i, compressedData in zip(missing, parallelMap(lambda i: compress(blobs[i], level), missing)):
+        cache.put(keys[i], compressedData)
+        results[i] = compressedData
+    return results
+
+def decompressAll(sections):
+    # Inflate every (uncompressedSize, compressedData) section, as given by DataInputStream.readCompressedSection().
+    return parallelMap(inflate, sections)
+
+def decompressArrays(items):
+    # Like decompressAll, but each item is (section, typecode, count), and each comes back as an array from inflateArray().
+    return parallelMap(lambda item: inflateArray(*item), items)
+
+def inflate(section):
+    # The section's data, in a bytearray allocated up front from the size given in its header.
+    uncompressedSize, compressedData = section
+    output = bytearray(uncompressedSize)
+    offset = 0
+    for chunk in decompressChunks(compressedData, uncompressedSize):
+        output[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return output
+
+def decompressChunks(compressedData, uncompressedSize):
+    # Inflate a bit at a time, so a section that decompresses to far more than it claims is caught early.
+    decompressor = zlib.decompressobj()
+    total = 0
+    try:
+        for start in xrange(0, len(compressedData), DECOMPRESS_CHUNK_SIZE):
+            data = buffer(compressedData, start, DECOMPRESS_CHUNK_SIZE)
+            while data:
+                chunk = decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+                data = decompressor.unconsumed_tail
+                total += len(chunk)
+                if total > uncompressedSize:
+                    break
+                yield chunk
+            if total > uncompressedSize:
+                break
+        chunk = decompressor.flush()
+    except zlib.error as e:
+        raise FormatException('Compressed section is corrupt: ' + str(e))
+    total += len(chunk)
+    if total != uncompressedSize:
+        raise FormatException('Compressed section was declared as ' + str(uncompressedSize) + ' bytes, but '
+            + (total > uncompressedSize and 'more' or 'only ' + str(total)) + ' bytes were decompressed.')
+    if chunk:
+        yield chunk
+
+def inflateArray(section, typecode, count):
+    # Inflate a section of count little-endian values straight into a compact array, a chunk at a time,
+    # so the whole section is never held as bytes as well.
+    uncompressedSize, compressedData = section
+    values = array.array(typecode)
+    if uncompressedSize != count * values.itemsize:
+        raise FormatException('Expected ' + str(count) + ' values (' + str(count * values.itemsize) + ' bytes) in compressed section, but it has ' + str(uncompressedSize) + ' bytes.')
+    # Chunks needn't end on a value boundary, so any partial value is carried over to the next one.
+    leftover = ''
+    for chunk in decompressChunks(compressedData, uncompressedSize):
+        if leftover:
+            chunk = leftover + chunk
+        end = len(chunk) - len(chunk) % values.itemsize
+        values.fromstring(buffer(chunk, 0, end))
+        leftover = chunk[end:]
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def fromArray(values, typecode):
+    # The reverse of inflateArray, before compressing: the values as a little-endian string of the given typecode.
+    # Lists (or arrays of another typecode) are converted first.
+    if not isinstance(values, array.array) or values.typecode != typecode:
+        try:
+            values = array.array(typecode, values)
+        except (OverflowError, TypeError) as e:
+            raise FormatException('Cannot store values as array(\'' + typecode + '\'): ' + str(e))
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+class FormatException(Exception):
+    pass
+
+class LRUCache(object):
+    # A mapping that holds at most 'capacity' items, dropping whichever was used least recently to make room.
+    # Keeps count of how many lookups were hits and misses.
+    # With a sizeOf function, the capacity limits the total sizeOf(value) of the items instead of how many there are.
+    # A capacity of None means no limit. onEvict(key, value) is called for each item dropped to make room.
+    def __init__(self, capacity, sizeOf=None, onEvict=None):
+        self.capacity = capacity
+        self.sizeOf = sizeOf or (lambda value: 1)
+        self.onEvict = onEvict
+        self.clear()
+        
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.items = {}
+        # Circular doubly-linked list of [previous, next, key, value], oldest first.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        
+    def __len__(self):
+        return len(self.items)
+        
+    def __contains__(self, key):
+        return key in self.items
+        
+    def get(self, key, default=None):
+        link = self.items.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.unlink(link)
+        self.append(link)
+        return link[3]
+        
+    def put(self, key, value):
+        link = self.items.get(key)
+        if link is not None:
+            self.unlink(link)
+            self.size -= self.sizeOf(link[3])
+            link[3] = value
+        else:
+            link = [None, None, key, value]
+            self.items[key] = link
+        self.size += self.sizeOf(value)
+        self.append(link)
+        self.trim()
+        
+    def setCapacity(self, capacity):
+        self.capacity = capacity
+        self.trim()
+        
+    def trim(self):
+        while self.capacity is not None and self.size > self.capacity:
+            key, value = self.root[1][2], self.root[1][3]
+            self.remove(key)
+            if self.onEvict:
+                self.onEvict(key, value)
+            
+    def remove(self, key):
+        link = self.items.pop(key, None)
+        if link is not None:
+            self.unlink(link)
+            self.size -= self.sizeOf(link[3])
+            
+    def unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+        
+    def append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = link
+        self.root[0] = link
 
 class DataInputStream(object):
     def __init__ (self, file):
         self.file = file
+        # Pull everything in one go, and then walk a cursor over it rather than hitting the file per field.
+        self.base = file.tell()
+        self.data = file.read()
+        self.position = 0
         
     def read(self, length):
-        return self.file.read(length)
+        s = self.data[self.position : self.position + length]
+        self.position += len(s)
+        return s
+        
+    def readView(self, length):
+        # A zero-copy slice of the underlying data, which struct and zlib accept directly.
+        v = buffer(self.data, self.position, length)
+        self.position += len(v)
+        return v
+        
+    def readStruct(self, s):
+        if self.position + s.size > len(self.data):
+            raise FormatException('Expected ' + str(s.size) + ' more bytes at offset ' + str(self.base + self.position) + ', but the data ended early.')
+        v = s.unpack_from(self.data, self.position)
+        self.position += s.size
+        return v
+        
+    def readStructs(self, s, count):
+        # Decode count back-to-back records of the same layout in one pass.
+        data = self.readView(s.size * count)
+        if len(data) != s.size * count:
+            raise FormatException('Expected ' + str(count) + ' records of ' + str(s.size) + ' bytes, but the data ended early.')
+        unpack = s.unpack_from
+        return [unpack(data, offset) for offset in xrange(0, s.size * count, s.size)]
         
     def readCompressed(self):
+        return inflate(self.readCompressedSection())
+        
+    def readCompressedSection(self):
+        # The next compressed section, without inflating it yet: (uncompressedSize, compressedData).
+        uncompressedSize, compressedSize = self.readCompressedHeader()
+        return uncompressedSize, self.readView(compressedSize)
+        
+    def readCompressedHeader(self):
+        # The (uncompressedSize, compressedSize) that a compressed section starts with, checked against the data that's left.
+        offset = self.tell()
         uncompressedSize = self.readInt()
         compressedSize = self.readInt()
-        compressedData = self.read(compressedSize)
-        uncompressedData = zlib.decompress(compressedData)
-        return uncompressedData
+        if uncompressedSize < 0:
+            raise FormatException('Compressed section at offset ' + str(offset) + ' claims a negative size of ' + str(uncompressedSize) + ' bytes.')
+        if compressedSize < 0 or self.position + compressedSize > len(self.data):
+            raise FormatException('Compressed section at offset ' + str(offset) + ' claims ' + str(compressedSize) + ' bytes, but the data ended early.')
+        return uncompressedSize, compressedSize
+        
+    def skipCompressed(self):
+        # Step over a compressed section without inflating it. Returns (offset, uncompressedSize, compressedSize),
+        # where offset is where the section starts, for seeking back to it later.
+        offset = self.tell()
+        uncompressedSize, compressedSize = self.readCompressedHeader()
+        self.position += compressedSize
+        return offset, uncompressedSize, compressedSize
+        
+    def readCompressedArray(self, typecode, count):
+        # Inflate a section of little-endian values directly into a compact array.
+        return inflateArray(self.readCompressedSection(), typecode, count)
         
     def readFixedString(self, length):
         s = self.read(length)
-        output = ''
-        for i in range(len(s)):
-            if s[i] != '\0':
-                output += s[i]
-            else:
-                break
-        return output
+        end = s.find('\0')
+        if end != -1:
+            return s[:end]
+        return s
                 
     def readChar(self):
-        v, = struct.unpack('<c', self.file.read(struct.calcsize('<c')))
+        v, = self.readStruct(CHAR)
         return v
 
     def readByte(self):
-        v, = struct.unpack('<b', self.file.read(struct.calcsize('<b')))
+        v, = self.readStruct(BYTE)
         return v
         
     def readUnsignedByte(self):
-        v, = struct.unpack('<B', self.file.read(struct.calcsize('<B')))
+        v, = self.readStruct(UNSIGNED_BYTE)
         return v
         
     def readShort(self):
-        v, = struct.unpack('<h', self.file.read(struct.calcsize('<h')))
+        v, = self.readStruct(SHORT)
         return v
         
     def readUnsignedShort(self):
-        v, = struct.unpack('<H', self.file.read(struct.calcsize('<H')))
+        v, = self.readStruct(UNSIGNED_SHORT)
         return v
         
     def readInt(self):
-        v, = struct.unpack('<i', self.file.read(struct.calcsize('<i')))
+        v, = self.readStruct(INT)
         return v
         
     def readUnsignedInt(self):
-        v, = struct.unpack('<I', self.file.read(struct.calcsize('<I')))
+        v, = self.readStruct(UNSIGNED_INT)
         return v
                 
     def readLong(self):
-        v, = struct.unpack('<l', self.file.read(struct.calcsize('<l')))
+        v, = self.readStruct(LONG)
         return v
         
     def readUnsignedLong(self):
-        v, = struct.unpack('<L', self.file.read(struct.calcsize('<L')))
+        v, = self.readStruct(UNSIGNED_LONG)
         return v
                 
     def readFloat(self):
-        v, = struct.unpack('<f', self.file.read(struct.calcsize('<f')))
+        v, = self.readStruct(FLOAT)
         return v
         
     def readDouble(self):
-        v, = struct.unpack('<d', self.file.read(struct.calcsize('<d')))
+        v, = self.readStruct(DOUBLE)
         return v
         
     def tell(self):
-        return self.file.tell()
+        return self.base + self.position
         
     def seek(self, offset, whence=0):
-        self.file.seek(offset, whence)
+        if whence == 0:
+            self.position = offset - self.base
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = len(self.data) + offset
+        self.position = max(self.position, 0)
     
     def close (self):
         self.file.close()
         
-class DataOutputStream(object):
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        self.close()
+        
+class MappedDataInputStream(DataInputStream):
     def __init__ (self, file):
         self.file = file
+        self.base = 0
+        self.position = 0
+        # Map the whole file read-only, so readView() slices point straight into the page cache.
+        try:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files (and things that aren't real files) can't be mapped.
+            file.seek(0)
+            self.data = file.read()
+        
+    def close (self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = ''
+        self.file.close()
+        
+class AtomicFile(object):
+    # Writes to a temporary file next to the target, and only replaces the target once closed successfully.
+    def __init__ (self, filename):
+        self.filename = filename
+        directory, name = os.path.split(filename)
+        fd, self.tempFilename = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+        self.file = os.fdopen(fd, 'wb')
+        
+    def write(self, blob):
+        self.file.write(blob)
+        
+    def close(self):
+        self.file.close()
+        # mkstemp makes the file private, so give it the permissions a plain open() would have.
+        if os.path.exists(self.filename):
+            mode = os.stat(self.filename).st_mode & 0o777
+            if os.name == 'nt':
+                os.remove(self.filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(self.tempFilename, mode)
+        os.rename(self.tempFilename, self.filename)
+        
+    def discard(self):
+        self.file.close()
+        os.remove(self.tempFilename)
+        
+class SectionCache(object):
+    # Compressed sections kept on disk, so saving a file again only needs to compress the sections that changed.
+    # Each is keyed by a hash of its uncompressed data and the compression level. Once the cache holds more than
+    # 'capacity' bytes, the least recently used sections are deleted. Keeps count of hits and misses.
+    def __init__(self, directory, capacity=SECTION_CACHE_CAPACITY):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = LRUCache(capacity, lambda size: size, self.evict)
+        # Sections left from earlier runs go in oldest first, so they get dropped before anything used in this one.
+        # (Reading a section touches its file, so the order carries over between runs.)
+        names = [name for name in os.listdir(directory) if name.endswith(SECTION_CACHE_SUFFIX)]
+        stats = [(os.stat(os.path.join(directory, name)), name) for name in names]
+        for stat, name in sorted(stats, key=lambda entry: entry[0].st_mtime):
+            self.entries.put(name[:-len(SECTION_CACHE_SUFFIX)], stat.st_size)
+        self.entries.hits = self.entries.misses = 0
+
+    @property
+    def hits(self):
+        return self.entries.hits
+
+    @property
+    def misses(self):
+        return self.entries.misses
+
+    def getKey(self, data, level=DEFAULT_COMPRESSION_LEVEL):
+        return hashlib.sha1(data).hexdigest() + '-' + str(level)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + SECTION_CACHE_SUFFIX)
+
+    def get(self, key):
+        # The compressed section stored for a key, or None.
+        if self.entries.get(key) is None:
+            return None
+        path = self.getPath(key)
+        try:
+            f = file(path, 'rb')
+            try:
+                compressedData = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+        except EnvironmentError:
+            # Someone else cleaned it up.
+            self.entries.remove(key)
+            self.entries.hits -= 1
+            self.entries.misses += 1
+            return None
+        return compressedData
+
+    def put(self, key, compressedData):
+        f = AtomicFile(self.getPath(key))
+        try:
+            f.write(compressedData)
+        except:
+            f.discard()
+            raise
+        f.close()
+        self.entries.put(key, len(compressedData))
+
+    def evict(self, key, size):
+        try:
+            os.remove(self.getPath(key))
+        except OSError:
+            pass
+
+    def report(self):
+        return 'Section cache: ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses.'
+
+class DataOutputStream(object):
+    def __init__ (self, file, cache=None):
+        # Everything is built up in memory, and handed to the file in a single write on close().
+        # Since seeking only ever happens within the buffer, the file doesn't need to be seekable.
+        # With a SectionCache, writeCompressed() reuses sections that were compressed before.
+        self.file = file
+        self.cache = cache
+        self.data = bytearray()
+        self.position = 0
         
     def write(self, blob):
-        return self.file.write(blob)
+        end = self.position + len(blob)
+        if self.position > len(self.data):
+            # Seeking past the end leaves a gap, which gets filled with zeroes like writeStruct() does.
+            self.data += '\0' * (self.position - len(self.data))
+        if self.position == len(self.data):
+            self.data += blob
+        else:
+            self.data[self.position : end] = blob
+        self.position = end
         
-    def writeCompressed(self, uncompressedData):
-        self.writeInt(len(uncompressedData))
-        compressedData = zlib.compress(uncompressedData)
+    def writeStruct(self, s, *values):
+        if self.position == len(self.data):
+            self.data += s.pack(*values)
+        else:
+            if self.position + s.size > len(self.data):
+                self.data += '\0' * (self.position + s.size - len(self.data))
+            s.pack_into(self.data, self.position, *values)
+        self.position += s.size
+        
+    def writeStructs(self, s, rows):
+        # Reserve room for every record up front, then pack each one in place.
+        offset = self.position
+        self.write('\0' * (s.size * len(rows)))
+        pack = s.pack_into
+        for row in rows:
+            pack(self.data, offset, *row)
+            offset += s.size
+        
+    def writeCompressed(self, uncompressedData, level=DEFAULT_COMPRESSION_LEVEL):
+        self.writeCompressedSection(len(uncompressedData), compressAll([uncompressedData], level, self.cache)[0])
+        
+    def writeCompressedSection(self, uncompressedSize, compressedData):
+        # Write data that was already compressed (by compressAll(), say).
+        self.writeInt(uncompressedSize)
         self.writeInt(len(compressedData))
         self.write(compressedData)
         
+    def writeCompressedArray(self, values, typecode, level=DEFAULT_COMPRESSION_LEVEL):
+        self.writeCompressed(fromArray(values, typecode), level)
+        
     def writeFixedString(self, s, length):
         self.write(s + ('\0' * (length - len(s))))
                 
     def writeChar(self, v):
-        self.write(struct.pack('<c', v))
+        self.writeStruct(CHAR, v)
 
     def writeByte(self, v):
-        self.write(struct.pack('<b', v))
+        self.writeStruct(BYTE, v)
         
     def writeUnsignedByte(self, v):
-        self.write(struct.pack('<B', v))
+        self.writeStruct(UNSIGNED_BYTE, v)
         
     def writeShort(self, v):
-        self.write(struct.pack('<h', v))
+        self.writeStruct(SHORT, v)
         
     def writeUnsignedShort(self, v):
-        self.write(struct.pack('<H', v))
+        self.writeStruct(UNSIGNED_SHORT, v)
         
     def writeInt(self, v):
-        self.write(struct.pack('<i', v))
+        self.writeStruct(INT, v)
         
     def writeUnsignedInt(self, v):
-        self.write(struct.pack('<I', v))
+        self.writeStruct(UNSIGNED_INT, v)
                 
     def writeLong(self, v):
-        self.write(struct.pack('<l', v))
+        self.writeStruct(LONG, v)
         
     def writeUnsignedLong(self, v):
-        self.write(struct.pack('<L', v))
+        self.writeStruct(UNSIGNED_LONG, v)
                 
     def writeFloat(self, v):
-        self.write(struct.pack('<f', v))
+        self.writeStruct(FLOAT, v)
         
     def writeDouble(self, v):
-        self.write(struct.pack('<d', v))
+        self.writeStruct(DOUBLE, v)
+        
+    def getvalue(self):
+        return str(self.data)
         
     def tell(self):
-        return self.file.tell()
+        return self.position
         
     def seek(self, offset, whence=0):
-        self.file.seek(offset, whence)
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = len(self.data) + offset
+        self.position = max(self.position, 0)
     
     def close(self):
-        self.file.close()
\ No newline at end of file
+        self.file.write(self.data)
+        self.data = bytearray()
+        self.file.close()
+        
+    def discard(self):
+        self.data = bytearray()
+        if hasattr(self.file, 'discard'):
+            self.file.discard()
+        else:
+            self.file.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.discard()
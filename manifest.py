@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import datastream
+
+# Where the tools keep their manifest by default, relative to the current directory.
+MANIFEST_FILENAME = 'v3tiled.manifest'
+# How much of a file gets hashed at a time.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hashFile(filename):
+    h = hashlib.sha1()
+    f = file(filename, 'rb')
+    try:
+        while True:
+            blob = f.read(HASH_CHUNK_SIZE)
+            if not blob:
+                break
+            h.update(blob)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def normalizePath(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+class Manifest(object):
+    # Remembers what each conversion was built from (a content hash of every input, and the options used),
+    # so an incremental run can skip any conversion whose outputs are already up to date.
+    # Hashes are remembered along with each file's size and modification time, and only recomputed when those change.
+    def __init__(self, filename=MANIFEST_FILENAME):
+        self.filename = filename
+        # path -> [size, mtime, hash]
+        self.files = {}
+        # key -> {'inputs': {path: hash}, 'outputs': {path: hash}, 'options': [...]}
+        self.builds = {}
+        self.skipped = 0
+        self.rebuilt = 0
+        if os.path.exists(filename):
+            try:
+                f = file(filename, 'rb')
+                try:
+                    doc = json.load(f)
+                finally:
+                    f.close()
+                self.files = doc['files']
+                self.builds = doc['builds']
+            except (IOError, ValueError, KeyError, TypeError):
+                # A damaged manifest just means everything gets rebuilt.
+                self.files = {}
+                self.builds = {}
+
+    def getHash(self, filename):
+        # The content hash of a file, or None if it doesn't exist.
+        path = normalizePath(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return None
+        entry = self.files.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            entry = [stat.st_size, stat.st_mtime, hashFile(path)]
+            self.files[path] = entry
+        return entry[2]
+
+    def getHashes(self, filenames):
+        return dict((normalizePath(filename), self.getHash(filename)) for filename in filenames)
+
+    def getKey(self, kind, filename):
+        # Builds are identified by what kind of conversion they are, and the file they're for.
+        return kind + ':' + normalizePath(filename)
+
+    def isUpToDate(self, key, inputs, outputs, options):
+        # Whether the outputs exist, haven't been touched since they were built,
+        # and were built from the same inputs with the same options.
+        build = self.builds.get(key)
+        if build is None or build['options'] != json.loads(json.dumps(options)):
+            return False
+        for hashes, filenames in ((build['inputs'], inputs), (build['outputs'], outputs)):
+            current = self.getHashes(filenames)
+            if None in current.values() or current != hashes:
+                return False
+        return True
+
+    def update(self, key, inputs, outputs, options):
+        # Record a successful build.
+        self.builds[key] = {
+            'inputs': self.getHashes(inputs),
+            'outputs': self.getHashes(outputs),
+            'options': options,
+        }
+
+    def report(self):
+        print(str(self.skipped) + ' up to date (skipped), ' + str(self.rebuilt) + ' rebuilt.')
+
+    def save(self):
+        f = datastream.AtomicFile(self.filename)
+        try:
+            json.dump({'files': self.files, 'builds': self.builds}, f, sort_keys=True)
+        except:
+            f.discard()
+            raise
+        f.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import os
+import json
+import datastream
+import v3formats
+
+def getVSPKey(filename):
+    return os.path.normcase(os.path.realpath(filename))
+
+if __name__ == '__main__':
+    import sys
+
+    def main():
+        dedup = False
+        level = datastream.DEFAULT_COMPRESSION_LEVEL
+        offsetsFilename = None
+        retargetFiles = []
+        files = []
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg.startswith('-'):
+                if arg ==  '-dedup':
+                    dedup = True
+                elif arg ==  '-level':
+                    try:
+                        level = int(next(args))
+                        if not 0 <= level <= 9:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-level\' needs a compression level from 0 to 9.\n')
+                        sys.exit(-1)
+                elif arg ==  '-offsets' or arg == '-retarget':
+                    try:
+                        filename = next(args)
+                    except StopIteration:
+                        sys.stderr.write(sys.argv[0] + ': option \'' + arg + '\' needs a filename.\n')
+                        sys.exit(-1)
+                    if arg == '-offsets':
+                        offsetsFilename = filename
+                    else:
+                        retargetFiles.append(filename)
+                else:
+                    print('')
+                    sys.stderr.write(sys.argv[0] + ': unknown option \'' + arg + '\'. run with no arguments to see usage.\n')
+                    sys.exit(-1)
+            else:
+                files.append(arg)
+        if len(files) < 3:
+            print('')
+            sys.stderr.write(sys.argv[0] + ': insufficient arguments.\n')
+            print('Usage: ' + sys.argv[0] + ' [OPTIONS] output vspfile vspfile [vspfile ...]')
+            print('')
+            print('Merges several .vsp files into one, so maps that used any of them can share a single tileset.')
+            print('The tiles, obstruction tiles and animations of each .vsp follow those of the one before.')
+            print('')
+            print('output: the name of the merged .vsp file to be generated.')
+            print('vspfile: a .vsp file to merge.')
+            print('')
+            print('OPTIONS:')
+            print('-dedup           keep only one copy of each tile and obstruction tile, like tovsp.py -dedup.')
+            print('-offsets FILE    save where the tiles of each .vsp ended up to FILE, as JSON.')
+            print('-retarget FILE   make FILE (a .map, .tmx or Tiled JSON .json that uses one of the .vsp files)')
+            print('                 use the merged .vsp instead, renumbering its tiles to match. FILE is')
+            print('                 rewritten in place. May be given more than once. Retargeting a Tiled')
+            print('                 document also saves the merged tileset images next to the output.')
+            print('-level N         compression level, from 1 (fastest) to 9 (smallest).')
+            print('                 0 stores the tiles without compressing them.')
+            return
+
+        outputFilename, vspFilenames = files[0], files[1:]
+        vsps = []
+        sources = {}
+        for name in vspFilenames:
+            if getVSPKey(name) in sources:
+                sys.stderr.write(sys.argv[0] + ': \'' + name + '\' was given more than once.\n')
+                sys.exit(1)
+            print('Loading \'' + name + '\'...')
+            vsp = v3formats.VSP()
+            try:
+                vsp.loadVSPFile(name)
+            except v3formats.FormatException as e:
+                sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                sys.exit(1)
+            sources[getVSPKey(name)] = len(vsps)
+            vsps.append(vsp)
+
+        print('Merging ' + str(len(vsps)) + ' tilesets...')
+        try:
+            merged, remaps = v3formats.mergeVSPs(vsps, dedup)
+            print('    ' + str(merged.tileCount) + ' tiles, ' + str(merged.obsCount) + ' obstruction tiles, ' + str(len(merged.animation)) + ' animations.')
+            merged.saveVSPFile(outputFilename, level)
+        except v3formats.FormatException as e:
+            sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+            sys.exit(1)
+        print('    Saved to \'' + outputFilename + '\'.')
+
+        if offsetsFilename:
+            # Without -dedup, each tileset's tiles are just moved along by its offset, but the full tables are written either way.
+            offsets = []
+            tileOffset = obsOffset = 0
+            for name, vsp, (tileRemap, obsRemap) in zip(vspFilenames, vsps, remaps):
+                offsets.append({'vsp': name, 'tileOffset': tileOffset, 'obsOffset': obsOffset, 'tiles': tileRemap, 'obstructions': obsRemap})
+                tileOffset += vsp.tileCount
+                obsOffset += vsp.obsCount
+            f = datastream.AtomicFile(offsetsFilename)
+            try:
+                json.dump({'output': outputFilename, 'sources': offsets}, f, sort_keys=True)
+            except:
+                f.discard()
+                raise
+            f.close()
+            print('Saved the offset tables to \'' + offsetsFilename + '\'.')
+
+        failed = 0
+        for name in retargetFiles:
+            print('Retargeting \'' + name + '\'...')
+            try:
+                map = v3formats.openMapDocument(name)
+                source = sources.get(getVSPKey(map.getVSPPath()))
+                if source is None:
+                    raise v3formats.FormatException('\'' + name + '\' uses the VSP \'' + map.vspFilename + '\', which isn\'t one of the ones being merged.')
+                map.vsp = merged
+                map.remapTiles(*remaps[source])
+                # Like any VSP filename, this is relative to the map.
+                map.vspFilename = os.path.relpath(outputFilename, os.path.dirname(os.path.abspath(name)))
+                v3formats.saveMapDocument(map, name, level)
+            except v3formats.FormatException as e:
+                sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                failed += 1
+        # Tiled documents show the tileset through its images, so the merged ones are needed.
+        if [name for name in retargetFiles if os.path.splitext(name)[1].lower() != '.map']:
+            print('Converting tileset...')
+            merged.dumpTiles()
+            print('Converting tileset obstructions...')
+            merged.dumpObs()
+        if failed:
+            sys.exit(1)
+
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Run with: python -m unittest test_v3formats
+import os
+import shutil
+import tempfile
+import unittest
+import v3formats
+
+class TestDecodeCSVGIDs(unittest.TestCase):
+    # Each test runs with numpy (if it's installed) and without it, since they take different paths.
+    def decode(self, text):
+        results = []
+        saved = v3formats.numpy
+        try:
+            for module in set([saved, None]):
+                v3formats.numpy = module
+                results.append(list(v3formats.decodeCSVGIDs(text)))
+        finally:
+            v3formats.numpy = saved
+        return results[0]
+
+    def assertInvalid(self, text):
+        saved = v3formats.numpy
+        try:
+            for module in set([saved, None]):
+                v3formats.numpy = module
+                self.assertRaises(v3formats.FormatException, v3formats.decodeCSVGIDs, text)
+        finally:
+            v3formats.numpy = saved
+
+    def testPlain(self):
+        self.assertEqual(self.decode('1,2,3'), [1, 2, 3])
+        self.assertEqual(self.decode('\n1, 2,\n3,\n'), [1, 2, 3])
+        self.assertEqual(self.decode(''), [])
+
+    def testSpaceSeparated(self):
+        self.assertInvalid('1,2 3')
+
+    def testNotANumber(self):
+        self.assertInvalid('1,x,3')
+        self.assertInvalid('1,,3')
+        self.assertInvalid('1,-2,3')
+
+    def testFlippedGID(self):
+        self.assertEqual(self.decode('2147483653,5'), [5, 5])
+        self.assertEqual(self.decode('4294967295'), [0x1FFFFFFF])
+
+    def testOutOfRange(self):
+        self.assertInvalid('99999999999')
+        self.assertInvalid('1,4294967296')
+
+class TestReadTiledJSONData(unittest.TestCase):
+    def testFlippedGID(self):
+        self.assertEqual(list(v3formats.readTiledJSONData({'data': [1, 2147483653]}, 2)), [1, 5])
+
+    def testOutOfRange(self):
+        self.assertRaises(v3formats.FormatException, v3formats.readTiledJSONData, {'data': [99999999999]}, 1)
+        self.assertRaises(v3formats.FormatException, v3formats.readTiledJSONData, {'data': [-1]}, 1)
+
+class TestSaveMapFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testListGrids(self):
+        # Grids are usually arrays, but plain lists should save the same way.
+        v3formats.VSP().saveVSPFile(os.path.join(self.directory, 'test.vsp'))
+        map = v3formats.Map()
+        map.mapName = 'test'
+        map.musicFilename = ''
+        map.renderOrder = ['1', 'E', 'R']
+        map.startEvent = ''
+        map.startX = map.startY = 0
+        map.width, map.height = 3, 2
+        layer = v3formats.Layer()
+        layer.id = 0
+        layer.name = 'Base'
+        layer.parallaxX = layer.parallaxY = 1.0
+        layer.width, layer.height = map.width, map.height
+        layer.alpha = 1.0
+        layer.data = [0, 1, 2, 3, 4, 65535]
+        map.layer = [layer]
+        map.obsLayer = [0, 1, 0, 1, 0, 255]
+        map.zoneLayer = [5, 4, 3, 2, 1, 0]
+        map.zone = []
+        map.entity = []
+        filename = os.path.join(self.directory, 'test.map')
+        map.saveMapFile(filename, 'test.vsp')
+
+        map = v3formats.Map.open(filename, False)
+        self.assertEqual(list(map.layer[0].data), [0, 1, 2, 3, 4, 65535])
+        self.assertEqual(list(map.obsLayer), [0, 1, 0, 1, 0, 255])
+        self.assertEqual(list(map.zoneLayer), [5, 4, 3, 2, 1, 0])
+
+if __name__ == '__main__':
+    unittest.main()
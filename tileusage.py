@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+import os
+import datastream
+import v3formats
+
+def formatRanges(indices):
+    # A sorted list of indices, written as a list of ranges, like '3, 7-12, 40'.
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ', '.join([start == end and str(start) or str(start) + '-' + str(end) for start, end in ranges])
+
+def isSameFile(a, b):
+    return os.path.normcase(os.path.realpath(a)) == os.path.normcase(os.path.realpath(b))
+
+if __name__ == '__main__':
+    import sys
+
+    def main():
+        prune = False
+        verbose = False
+        level = datastream.DEFAULT_COMPRESSION_LEVEL
+        files = []
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg.startswith('-'):
+                if arg ==  '-prune':
+                    prune = True
+                elif arg ==  '-v':
+                    verbose = True
+                elif arg ==  '-level':
+                    try:
+                        level = int(next(args))
+                        if not 0 <= level <= 9:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-level\' needs a compression level from 0 to 9.\n')
+                        sys.exit(-1)
+                else:
+                    print('')
+                    sys.stderr.write(sys.argv[0] + ': unknown option \'' + arg + '\'. run with no arguments to see usage.\n')
+                    sys.exit(-1)
+            else:
+                files.append(arg)
+        if len(files) < 2:
+            print('')
+            sys.stderr.write(sys.argv[0] + ': insufficient arguments.\n')
+            print('Usage: ' + sys.argv[0] + ' [OPTIONS] vspfile mapfile [mapfile ...]')
+            print('')
+            print('Counts how many times each tile of a .vsp is used by the layers of a set of maps,')
+            print('and lists the tiles that none of them use. Tiles that are part of an animation,')
+            print('and tile 0, always count as used.')
+            print('')
+            print('vspfile: the .vsp file to check.')
+            print('mapfile: a .map file that uses the .vsp.')
+            print('')
+            print('OPTIONS:')
+            print('-v               list how many times each used tile is used.')
+            print('-prune           remove the unused tiles from the .vsp, and renumber the tiles')
+            print('                 of every map to match. Both are rewritten in place, so every map')
+            print('                 that uses the .vsp should be given.')
+            print('-level N         compression level for the rewritten files, from 1 (fastest)')
+            print('                 to 9 (smallest). 0 stores them without compressing them.')
+            return
+
+        vspFilename, mapFilenames = files[0], files[1:]
+        vsp = v3formats.VSP()
+        print('Loading \'' + vspFilename + '\'...')
+        try:
+            vsp.loadVSPFile(vspFilename)
+        except v3formats.FormatException as e:
+            sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+            sys.exit(1)
+
+        usage = [0] * vsp.tileCount
+        maps = []
+        failed = 0
+        for name in mapFilenames:
+            print('Counting tiles in \'' + name + '\'...')
+            try:
+                map = v3formats.Map.open(name)
+                if not isSameFile(map.getVSPPath(), vspFilename):
+                    raise v3formats.FormatException('The MAP file \'' + name + '\' uses the VSP \'' + map.vspFilename + '\', not \'' + vspFilename + '\'.')
+                for layer in map.layer:
+                    counts = v3formats.countValues(layer.data, vsp.tileCount)
+                    if len(counts) > vsp.tileCount:
+                        raise v3formats.FormatException('Layer #' + str(layer.id) + ' of \'' + name + '\' uses tile ' + str(len(counts) - 1)
+                            + ', but \'' + vspFilename + '\' only has ' + str(vsp.tileCount) + ' tiles.')
+                    usage = [a + b for a, b in zip(usage, counts)]
+                maps.append(map)
+            except v3formats.FormatException as e:
+                sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                failed += 1
+
+        used = set([i for i, count in enumerate(usage) if count])
+        kept = (vsp.getAnimatedTiles() | set([0])) - used
+        unused = [i for i in xrange(vsp.tileCount) if i not in used and i not in kept]
+        if verbose:
+            for i in sorted(used):
+                print('    Tile ' + str(i) + ': used ' + str(usage[i]) + ' times.')
+        print(str(len(used)) + ' of ' + str(vsp.tileCount) + ' tiles are used'
+            + ' (and ' + str(len([i for i in kept if i < vsp.tileCount])) + ' more are animated or tile 0).')
+        print('Unused tiles: ' + (formatRanges(unused) or 'none') + '.')
+
+        if prune:
+            if failed:
+                sys.stderr.write(sys.argv[0] + ': not pruning, since not every map could be counted.\n')
+                sys.exit(1)
+            tileRemap, obsRemap = vsp.prune(used)
+            try:
+                # Every map is renumbered in memory first, so nothing is written unless they all can be.
+                for map in maps:
+                    map.vsp = vsp
+                    map.remapTiles(tileRemap, obsRemap)
+                print('Saving \'' + vspFilename + '\' with ' + str(vsp.tileCount) + ' tiles...')
+                vsp.saveVSPFile(vspFilename, level)
+                for name, map in zip(mapFilenames, maps):
+                    print('Renumbering \'' + name + '\'...')
+                    v3formats.saveMapDocument(map, name, level)
+            except v3formats.FormatException as e:
+                sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                sys.exit(1)
+        if failed:
+            sys.exit(1)
+
+    main()
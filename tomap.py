@@ -1,28 +1,96 @@
 #!/usr/bin/env python
+import datastream
 import v3formats
+import manifest
 
 if __name__ == '__main__':
     import sys
     
     def main():
-        if len(sys.argv) == 4:
+        manifestFilename = None
+        cacheDirectory = None
+        level = datastream.DEFAULT_COMPRESSION_LEVEL
+        files = []
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg ==  '-i':
+                manifestFilename = manifestFilename or manifest.MANIFEST_FILENAME
+            elif arg ==  '-threads':
+                try:
+                    threads = int(next(args))
+                    if threads <= 0:
+                        raise ValueError()
+                except (StopIteration, ValueError):
+                    sys.stderr.write(sys.argv[0] + ': option \'-threads\' needs a positive number of threads.\n')
+                    sys.exit(-1)
+                datastream.setCompressionThreads(threads)
+            elif arg ==  '-level':
+                try:
+                    level = int(next(args))
+                    if not 0 <= level <= 9:
+                        raise ValueError()
+                except (StopIteration, ValueError):
+                    sys.stderr.write(sys.argv[0] + ': option \'-level\' needs a compression level from 0 to 9.\n')
+                    sys.exit(-1)
+            elif arg ==  '-cache':
+                try:
+                    cacheDirectory = next(args)
+                except StopIteration:
+                    sys.stderr.write(sys.argv[0] + ': option \'-cache\' needs a directory.\n')
+                    sys.exit(-1)
+            elif arg ==  '-manifest':
+                try:
+                    manifestFilename = next(args)
+                except StopIteration:
+                    sys.stderr.write(sys.argv[0] + ': option \'-manifest\' needs a filename.\n')
+                    sys.exit(-1)
+            else:
+                files.append(arg)
+        if len(files) == 3:
+            outputFilename, tiledFilename, vspFilename = files
+            if manifestFilename:
+                manifestFile = manifest.Manifest(manifestFilename)
+                key = manifestFile.getKey('tomap', outputFilename)
+                dependencies = [tiledFilename], [outputFilename], [vspFilename, level]
+                if manifestFile.isUpToDate(key, *dependencies):
+                    manifestFile.skipped += 1
+                    print('\'' + outputFilename + '\' is up to date.')
+                    manifestFile.report()
+                    return
             map = v3formats.Map()
-            print('Converting ' + sys.argv[2] + '...')
+            print('Converting ' + tiledFilename + '...')
             try:
-                map.convertFromTiled(sys.argv[2])
+                if tiledFilename.lower().endswith('.json'):
+                    map.convertFromTiledJSON(tiledFilename)
+                else:
+                    map.convertFromTiled(tiledFilename)
             except v3formats.FormatException as e:
                 sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
-                return
-            map.vspFilename = sys.argv[3]
+                sys.exit(1)
+            map.vspFilename = vspFilename
             print('    Saving document...')
-            map.saveMapFile(sys.argv[1], sys.argv[3])
+            cache = None
+            if cacheDirectory:
+                try:
+                    cache = datastream.SectionCache(cacheDirectory)
+                except EnvironmentError as e:
+                    sys.stderr.write(sys.argv[0] + ': the cache directory \'' + cacheDirectory + '\' could not be used: ' + str(e) + '\n')
+                    sys.exit(1)
+            map.saveMapFile(outputFilename, vspFilename, level, cache)
+            if cache:
+                print('    ' + cache.report())
+            if manifestFilename:
+                manifestFile.rebuilt += 1
+                manifestFile.update(key, *dependencies)
+                manifestFile.save()
+                manifestFile.report()
             print('Done.')
         else:
             print('')
-            sys.stderr.write(sys.argv[0] + ': ' + (len(sys.argv) < 4 and 'insufficient' or 'too many') + ' arguments.\n')
-            print('Usage: ' + sys.argv[0] + ' outputfile tmxfile vspfile')
+            sys.stderr.write(sys.argv[0] + ': ' + (len(files) < 3 and 'insufficient' or 'too many') + ' arguments.\n')
+            print('Usage: ' + sys.argv[0] + ' [OPTIONS] outputfile tmxfile vspfile')
             print('')
-            print('Converts a tiled .tmx file back to Verge-friendly .map file.')
+            print('Converts a tiled .tmx (or Tiled JSON .json) file back to Verge-friendly .map file.')
             print('')
             print('outputfile: the name of the .map file to be generated.')
             print('tmxfile: a tiled map format to convert back. This may require the tmx\'s')
@@ -30,5 +98,15 @@ if __name__ == '__main__':
             print('vspfile: the name of the vsp file the map needs.')
             print('         IMPORTANT: Path must be relative to the map and should not use ../')
             print('         (but this tool will not verify that.)')
+            print('')
+            print('OPTIONS:')
+            print('-i               incremental: do nothing if the .map is already up to date.')
+            print('                 what it was built from is kept in \'' + manifest.MANIFEST_FILENAME + '\'.')
+            print('-manifest FILE   incremental, keeping the manifest in FILE instead.')
+            print('-level N         compression level, from 1 (fastest) to 9 (smallest).')
+            print('                 0 stores the layers without compressing them.')
+            print('-cache DIR       keep compressed layers in DIR, so layers that haven\'t changed since')
+            print('                 the last save don\'t need to be compressed again.')
+            print('-threads N       compress the map\'s layers with N threads. (default: the number of CPUs)')
     
-    main()
\ No newline at end of file
+    main()
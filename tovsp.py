@@ -1,18 +1,106 @@
 #!/usr/bin/env python
+import os
+import json
+import datastream
 import v3formats
 
+def isSameFile(a, b):
+    return os.path.normcase(os.path.realpath(a)) == os.path.normcase(os.path.realpath(b))
+
 if __name__ == '__main__':
     import sys
     
     def main():
-        if len(sys.argv) == 4 or len(sys.argv) == 5:
+        level = datastream.DEFAULT_COMPRESSION_LEVEL
+        dedup = False
+        remapFilename = None
+        rewriteFiles = []
+        files = []
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg ==  '-level':
+                try:
+                    level = int(next(args))
+                    if not 0 <= level <= 9:
+                        raise ValueError()
+                except (StopIteration, ValueError):
+                    sys.stderr.write(sys.argv[0] + ': option \'-level\' needs a compression level from 0 to 9.\n')
+                    sys.exit(-1)
+            elif arg ==  '-dedup':
+                dedup = True
+            elif arg ==  '-remap' or arg == '-rewrite':
+                try:
+                    filename = next(args)
+                except StopIteration:
+                    sys.stderr.write(sys.argv[0] + ': option \'' + arg + '\' needs a filename.\n')
+                    sys.exit(-1)
+                if arg == '-remap':
+                    remapFilename = filename
+                else:
+                    rewriteFiles.append(filename)
+            else:
+                files.append(arg)
+        if (remapFilename or rewriteFiles) and not dedup:
+            sys.stderr.write(sys.argv[0] + ': options \'-remap\' and \'-rewrite\' need \'-dedup\'.\n')
+            sys.exit(-1)
+        if len(files) == 3 or len(files) == 4:
+            # Every map to rewrite is loaded and checked first, and renumbered in memory before the VSP is saved,
+            # so nothing gets written unless they all can be renumbered.
+            maps = []
+            for filename in rewriteFiles:
+                try:
+                    map = v3formats.openMapDocument(filename)
+                    if not isSameFile(map.getVSPPath(), files[0]):
+                        raise v3formats.FormatException('\'' + filename + '\' uses the VSP \'' + map.vspFilename + '\', not \'' + files[0] + '\'.')
+                except v3formats.FormatException as e:
+                    sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                    sys.exit(1)
+                maps.append(map)
             vsp = v3formats.VSP()
-            vsp.buildFromExternal(sys.argv[2], sys.argv[3], len(sys.argv) == 5 and sys.argv[4] or None)
-            vsp.saveVSPFile(sys.argv[1])
+            try:
+                vsp.buildFromExternal(files[1], files[2], len(files) == 4 and files[3] or None)
+                if dedup:
+                    tileCount, obsCount = vsp.tileCount, vsp.obsCount
+                    tileRemap, obsRemap = vsp.dedup()
+                    print('Removed ' + str(tileCount - vsp.tileCount) + ' duplicate tiles (' + str(vsp.tileCount) + ' left), and '
+                        + str(obsCount - vsp.obsCount) + ' duplicate obstruction tiles (' + str(vsp.obsCount) + ' left).')
+                for filename, map in zip(rewriteFiles, maps):
+                    print('Renumbering \'' + filename + '\'...')
+                    map.vsp = vsp
+                    map.remapTiles(tileRemap, obsRemap)
+                vsp.saveVSPFile(files[0], level)
+            except v3formats.FormatException as e:
+                sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                sys.exit(1)
+            if remapFilename:
+                f = datastream.AtomicFile(remapFilename)
+                try:
+                    json.dump({'tiles': tileRemap, 'obstructions': obsRemap}, f)
+                except:
+                    f.discard()
+                    raise
+                f.close()
+                print('Saved the remap table to \'' + remapFilename + '\'.')
+            failed = 0
+            for filename, map in zip(rewriteFiles, maps):
+                print('Saving \'' + filename + '\'...')
+                try:
+                    v3formats.saveMapDocument(map, filename, level)
+                except v3formats.FormatException as e:
+                    sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+                    failed += 1
+            # Tiled documents show the tileset through its images, which now need to match.
+            if [filename for filename in rewriteFiles if os.path.splitext(filename)[1].lower() != '.map']:
+                print('Converting tileset...')
+                vsp.dumpTiles()
+                print('Converting tileset obstructions...')
+                vsp.dumpObs()
+            if failed:
+                sys.exit(1)
         else:
             print('')
-            sys.stderr.write(sys.argv[0] + ': ' + (len(sys.argv) < 4 and 'insufficient' or 'too many') + ' arguments.\n')
-            print('Usage: ' + sys.argv[0] + ' output tile obs [anim]')
+            sys.stderr.write(sys.argv[0] + ': ' + (len(files) < 3 and 'insufficient' or 'too many') + ' arguments.\n')
+            print('Usage: ' + sys.argv[0] + ' [OPTIONS] output tile obs [anim]')
             print('')
             print('Combines images and animation information to make a .vsp file.')
             print('')
@@ -23,5 +111,17 @@ if __name__ == '__main__':
             print('     is treated as 0 (passible), and 1 (obstruction) otherwise.')
             print('anim: an optional .anim file which describes animations used by the ')
             print('      tileset. This is an XML format.')
+            print('')
+            print('OPTIONS:')
+            print('-level N         compression level, from 1 (fastest) to 9 (smallest).')
+            print('                 0 stores the tiles without compressing them.')
+            print('-dedup           keep only one copy of each tile and obstruction tile. Animated tiles,')
+            print('                 and tile 0 (unless it is blank) are always kept as they are.')
+            print('-remap FILE      with -dedup, save the new index of every old tile and obstruction')
+            print('                 tile to FILE, as JSON: {"tiles": [...], "obstructions": [...]}.')
+            print('-rewrite FILE    with -dedup, renumber the tiles used by FILE (a .map, .tmx or Tiled')
+            print('                 JSON .json that uses the output .vsp) in place. May be given more')
+            print('                 than once. Rewriting a Tiled document also saves the new tileset')
+            print('                 images next to the .vsp.')
     
-    main()
\ No newline at end of file
+    main()
@@ -6,24 +6,33 @@ if __name__ == '__main__':
     
     def main():
         count = 0
-        needVSP = False
-        compress = True
-        for i in range(1, len(sys.argv)):
-            arg = sys.argv[i]
+        failed = 0
+        workers = v3tiled.defaultJobCount()
+        jobs = []
+        seenVSPs = set()
+        args = iter(sys.argv[1:])
+        for arg in args:
             if arg.startswith('-'):
-                if False:
-                    pass
+                if arg ==  '-j':
+                    try:
+                        workers = int(next(args))
+                        if workers <= 0:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-j\' needs a positive number of jobs.\n')
+                        sys.exit(-1)
                 else:
                     print('')
                     sys.stderr.write(sys.argv[0] + ': unknown option \'' + arg + '\'. run with no arguments to see usage.\n')
                     sys.exit(-1)
             else:
                 count += 1
-                print('')
                 if arg.lower().endswith('.vsp'):
-                    v3tiled.convertVSP(arg)
+                    v3tiled.addVSPJob(jobs, seenVSPs, arg)
                 else:
                     sys.stderr.write(sys.argv[0] + ': file \'' + arg + '\' is not a VSP.\n')
+                    failed += 1
+        failed += v3tiled.convertFiles(jobs, workers).count(False)
         if count == 0:
             print('')
             sys.stderr.write(sys.argv[0] + ': no input files\n')
@@ -36,6 +45,9 @@ if __name__ == '__main__':
             print('    is a .vsp, it exports a .png, as well as a .anim file which')
             print('    is used to store the animation info of the original VSP.')
             print('')
-            print('OPTIONS: none in this version.')
+            print('OPTIONS:')
+            print('-j N             convert up to N files at once. (default: the number of CPUs)')
+        if failed:
+            sys.exit(1)
     
-    main()
\ No newline at end of file
+    main()
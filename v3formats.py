@@ -1,16 +1,24 @@
 import datastream
+import sys
+import array
 import struct
 import base64
 import zlib
+import json
 import os.path
-import xml.dom.minidom
+import xmlstream
 import PIL.Image
+import PIL.ImageChops
 import PIL.ImageDraw
 import PIL.ImageFont
 from xml.etree import cElementTree as etree
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class FormatException(Exception):
-    pass
+FormatException = datastream.FormatException
+LRUCache = datastream.LRUCache
 
 def getNodeName(node):
     if hasattr(node, 'tag'):
@@ -42,17 +50,88 @@ def getNumericNode(node, attr, default=None):
         raise FormatException('Required attribute \'' + attr + '\' on ' + getNodeName(node) + ' is missing.')
 
 def getProperties(elem):
+    # Nodes from Tiled JSON documents are dicts.
+    if type(elem) == dict:
+        return readJSONProperties(elem.get('properties'))
     props = elem.find('properties')
     if not props:
         return {}
     else:
-        d = {}
-        d['_node'] = '<properties>'
-        for prop in props.iter('property'):
-            if prop.get('name'):
-                d[prop.get('name')] = prop.get('value')
-        return d
+        return readProperties(props)
 
+def readProperties(props):
+    d = {}
+    d['_node'] = '<properties>'
+    for prop in props.iter('property'):
+        if prop.get('name'):
+            d[prop.get('name')] = prop.get('value')
+    return d
+
+def readJSONProperties(props):
+    # Older Tiled JSON stores properties as an object of name: value, and newer versions as a list of {name, type, value}.
+    # Either way, values are turned into the same strings a .tmx would have.
+    d = {}
+    d['_node'] = '"properties"'
+    if type(props) == list:
+        props = dict((prop.get('name'), prop.get('value')) for prop in props)
+    for name, value in (props or {}).iteritems():
+        if value is True or value is False:
+            value = value and 'true' or 'false'
+        elif value is not None and not isinstance(value, basestring):
+            value = str(value)
+        if name:
+            d[name] = value
+    return d
+
+def fromJSONText(s):
+    # The json module hands back unicode strings, but everything else here deals in byte strings.
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def decodeJSONObject(d):
+    return dict((fromJSONText(k), fromJSONText(v)) for k, v in d.iteritems())
+
+class LazyAttributes(object):
+    # Attributes can be given a loader with setLazy(), which gets called the first time the attribute is read.
+    # Assigning the attribute before then skips the loader.
+    def setLazy(self, name, loader):
+        self.__dict__.setdefault('lazyLoaders', {})[name] = loader
+        
+    def isLoaded(self, name):
+        return name in self.__dict__
+        
+    def __getattr__(self, name):
+        loaders = self.__dict__.get('lazyLoaders')
+        if loaders and name in loaders:
+            value = loaders.pop(name)()
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
+class RecordSchema(object):
+    # A fixed-size record layout, given as (attribute, format) pairs and compiled into a single struct.
+    # Fields with no attribute name are unused, and get written as zero.
+    # Fixed strings ('256s' and so on) are cut at the first NUL when read.
+    def __init__(self, *fields):
+        self.names = [name for name, format in fields]
+        self.struct = struct.Struct('<' + ''.join(format for name, format in fields))
+        self.size = self.struct.size
+        self.strings = [i for i, (name, format) in enumerate(fields) if format.endswith('s')]
+        self.defaults = [('' if format.endswith('s') else 0) for name, format in fields]
+        
+    def read(self, f, count):
+        records = []
+        for values in f.readStructs(self.struct, count):
+            values = list(values)
+            for i in self.strings:
+                values[i] = values[i].split('\0', 1)[0]
+            records.append(dict((name, v) for name, v in zip(self.names, values) if name))
+        return records
+        
+    def write(self, f, records):
+        f.writeStructs(self.struct, [[(record[name] if name else default) for name, default in zip(self.names, self.defaults)] for record in records])
+        
 
 ANIMATION_MODE = {
     '0': 'forward',
@@ -73,19 +152,34 @@ class Animation(object):
         self.mode = kwargs.get('mode', 'forward')
     
     def readFromVSP(self, f):
-        self.name = f.readFixedString(256)
-        self.start = f.readInt()
-        self.end = f.readInt()
-        self.delay = f.readInt()
-        self.mode = ANIMATION_MODE.get(f.readInt(), 'forward')
+        self.fromRecord(ANIMATION_RECORD.read(f, 1)[0])
         
     def writeToVSP(self, f):
-        f.writeFixedString(self.name, 256)
-        f.writeInt(self.start)
-        f.writeInt(self.end)
-        f.writeInt(self.delay)
-        f.writeInt(ANIMATION_MODE_OUT.get(self.mode, 0))
+        ANIMATION_RECORD.write(f, [self.toRecord()])
         
+    def fromRecord(self, record):
+        self.name = record['name']
+        self.start = record['start']
+        self.end = record['end']
+        self.delay = record['delay']
+        self.mode = ANIMATION_MODE.get(record['mode'], 'forward')
+        
+    def toRecord(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'delay': self.delay,
+            'mode': ANIMATION_MODE_OUT.get(self.mode, 0),
+        }
+        
+ANIMATION_RECORD = RecordSchema(
+    ('name', '256s'),
+    ('start', 'i'),
+    ('end', 'i'),
+    ('delay', 'i'),
+    ('mode', 'i'),
+)
 
 
 VSP_SIGNATURE = 5264214
@@ -93,104 +187,215 @@ VSP_VERSION = 6
 VSP_FORMAT = 1
 VSP_COMPRESSION = 1
 VSP_TILESIZE  = 16
+# How many decoded tile images a VSP keeps around for tileImage() and obsTileImage().
+VSP_TILE_IMAGE_CACHE_SIZE = 1024
+# What gets added onto a VSP's filename to name the images it's converted into.
+VSP_TILE_IMAGE_NAME = '.tile.png'
+VSP_OBS_IMAGE_NAME = '.obs.png'
+    
+# Lookup tables for Image.point(), used to build masks a whole channel at a time.
+MATCH_0 = [255] + [0] * 255
+MATCH_255 = [0] * 255 + [255]
+NONZERO_255 = [0] + [255] * 255
+NONZERO_127 = [0] + [127] * 255
+NONZERO_1 = [0] + [1] * 255
+
+def getImageBytes(image):
+    # Pillow renamed tostring() to tobytes().
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+def colorKeyImage(rgb):
+    # Turn an RGB image into RGBA, where #ff00ff (the color key) becomes transparent.
+    # The key mask is where all three channels match it, built a whole channel at a time.
+    r, g, b = rgb.split()
+    key = PIL.ImageChops.multiply(PIL.ImageChops.multiply(r.point(MATCH_255), g.point(MATCH_0)), b.point(MATCH_255))
+    return PIL.Image.merge('RGBA', (r, g, b, PIL.ImageChops.invert(key)))
+
+def obsMaskImage(obs):
+    # Turn obstruction data into RGBA, where obstructed pixels become (255, 255, 255, 127), and everything else (0, 0, 0, 0).
+    color = obs.point(NONZERO_255)
+    return PIL.Image.merge('RGBA', (color, color, color, obs.point(NONZERO_127)))
+
+def getTileSheetRows(count):
+    # How many rows of 20 tiles the sheet images of a VSP have. There's always a spare row at the bottom,
+    # so a count that's a multiple of 20 gets a whole empty row.
+    return count // 20 + 1
+
+def arrangeTileSheet(pixels, count, pixelSize):
+    # Rearrange tile-major pixel data (each tile's 16x16 pixels stored one after another) into the rows of a
+    # sheet image that is 20 tiles across (see getTileSheetRows). Unused space is zeroed.
+    rows = getTileSheetRows(count)
+    lineSize = VSP_TILESIZE * pixelSize
+    tileSize = VSP_TILESIZE * lineSize
+    pixels = pixels[:count * tileSize] + '\0' * ((rows * 20 - count) * tileSize)
+    return ''.join([pixels[offset : offset + lineSize]
+        for row in xrange(0, rows * 20 * tileSize, 20 * tileSize)
+            for line in xrange(row, row + tileSize, lineSize)
+                for offset in xrange(line, line + 20 * tileSize, tileSize)])
+    
+def splitTileSheet(pixels, width, height, pixelSize):
+    # The reverse of arrangeTileSheet: cut a row-major image, width x height pixels, into tile-major pixel data.
+    lineSize = VSP_TILESIZE * pixelSize
+    stride = width * pixelSize
+    return ''.join([pixels[offset : offset + lineSize]
+        for row in xrange(0, height * stride, VSP_TILESIZE * stride)
+            for tile in xrange(row, row + stride, lineSize)
+                for offset in xrange(tile, tile + VSP_TILESIZE * stride, stride)])
+    
+def dedupTiles(pixels, count, size, pinned=()):
+    # Find the distinct tiles in tile-major pixel data, with size bytes per tile, by hashing each tile's whole pixel block.
+    # Returns the indices of the tiles to keep (the first of each set of identical tiles, in order), and a remap table
+    # with the new index of every tile. Pinned tiles are always kept, and never have other tiles merged into them.
+    first = {}
+    tiles = []
+    remap = []
+    for i in xrange(count):
+        if i in pinned:
+            index = len(tiles)
+            tiles.append(i)
+        else:
+            block = pixels[i * size : (i + 1) * size]
+            index = first.get(block)
+            if index is None:
+                index = first[block] = len(tiles)
+                tiles.append(i)
+        remap.append(index)
+    return tiles, remap
+    
+def selectTiles(pixels, indices, size):
+    # Tile-major pixel data of just the given tiles, in the order given.
+    return ''.join([pixels[i * size : (i + 1) * size] for i in indices])
     
 class VSP(object):
     def __init__(self):
-        pass
+        # Pixel data is always kept as a str, tile-major: each tile's 16x16 pixels are stored one after another,
+        # three bytes (RGB) per pixel for tiles, and one byte (0 or 1) per pixel for obstructions.
+        self.filename = ''
+        self.tileCount = 0
+        self.tilePixels = ''
+        self.obsCount = 0
+        self.obsPixels = ''
+        self.animation = []
+        self.tileImageCache = LRUCache(VSP_TILE_IMAGE_CACHE_SIZE)
+        
+    def tile(self, index):
+        # Zero-copy view of the RGB pixels of a single tile.
+        if index < 0 or index >= self.tileCount:
+            raise IndexError('Tile index ' + str(index) + ' out of range.')
+        size = VSP_TILESIZE * VSP_TILESIZE * 3
+        return buffer(self.tilePixels, index * size, size)
+        
+    def obsTile(self, index):
+        # Zero-copy view of the pixels of a single obstruction tile.
+        if index < 0 or index >= self.obsCount:
+            raise IndexError('Obstruction tile index ' + str(index) + ' out of range.')
+        size = VSP_TILESIZE * VSP_TILESIZE
+        return buffer(self.obsPixels, index * size, size)
+        
+    def tileImage(self, index):
+        # A tile as an RGBA image, like it appears in the .tile.png sheet. Recently used tiles are cached.
+        key = ('tile', index)
+        image = self.tileImageCache.get(key)
+        if image is None:
+            image = colorKeyImage(PIL.Image.frombuffer('RGB', (VSP_TILESIZE, VSP_TILESIZE), self.tile(index), 'raw', 'RGB', 0, 1))
+            self.tileImageCache.put(key, image)
+        return image
+        
+    def obsTileImage(self, index):
+        # An obstruction tile as an RGBA image, like it appears in the .obs.png sheet. Recently used tiles are cached.
+        key = ('obs', index)
+        image = self.tileImageCache.get(key)
+        if image is None:
+            image = obsMaskImage(PIL.Image.frombuffer('L', (VSP_TILESIZE, VSP_TILESIZE), self.obsTile(index), 'raw', 'L', 0, 1))
+            self.tileImageCache.put(key, image)
+        return image
         
     def loadVSPFile(self, filename):
         self.filename = filename
+        self.tileImageCache.clear()
         try:
-            f = datastream.DataInputStream(file(filename, 'rb'))
+            f = datastream.MappedDataInputStream(file(filename, 'rb'))
         except IOError:
             raise FormatException('VSP file \'' + filename + '\' was not found.')
         
-        signature = f.readInt()
-        version = f.readInt()
+        with f:
+            signature = f.readInt()
+            version = f.readInt()
         
-        if signature != VSP_SIGNATURE:
-            raise FormatException('VSP has a bad signature of ' + signature)
-        if version != VSP_VERSION:
-            raise FormatException('VSP has a bad version of ' + str(version))
+            if signature != VSP_SIGNATURE:
+                raise FormatException('VSP has a bad signature of ' + signature)
+            if version != VSP_VERSION:
+                raise FormatException('VSP has a bad version of ' + str(version))
             
-        tilesize = f.readInt()
-        format = f.readInt()
-        self.tileCount = f.readInt()
-        compression = f.readInt()
+            tilesize = f.readInt()
+            format = f.readInt()
+            self.tileCount = f.readInt()
+            compression = f.readInt()
         
-        self.tileset = []
+            self.tileset = []
         
-        self.tilePixels = f.readCompressed()
-        self.tileImageName = '.tile.png'
-        self.tileLastGID = ((self.tileCount + 19) // 20) * 20
+            tileSection = f.readCompressedSection()
             
-        self.animation = []
-        animationCount = f.readInt()
-        for i in range(animationCount):
-            anim = Animation()
-            anim.id = i
-            anim.readFromVSP(f)
-            self.animation.append(anim)
-        
-        self.obs = []
-        self.obsCount = f.readInt()
-        self.obsImageName = '.obs.png' 
-        self.obsPixels = f.readCompressed()
+            self.animation = []
+            animationCount = f.readInt()
+            for i, record in enumerate(ANIMATION_RECORD.read(f, animationCount)):
+                anim = Animation()
+                anim.id = i
+                anim.fromRecord(record)
+                self.animation.append(anim)
+        
+            self.obs = []
+            self.obsCount = f.readInt()
+            obsSection = f.readCompressedSection()
+            # Both sections get inflated at once, then kept as strs, the same as the pixels of a VSP built from images.
+            self.tilePixels, self.obsPixels = [str(pixels) for pixels in datastream.decompressAll([tileSection, obsSection])]
+            self.updateGIDs()
+            
+    def updateGIDs(self):
+        # Where the tiles and obstructions go in a Tiled export, which depends on how many there are.
+        self.tileImageName = VSP_TILE_IMAGE_NAME
+        self.tileLastGID = ((self.tileCount + 19) // 20) * 20
+        self.obsImageName = VSP_OBS_IMAGE_NAME
         self.obsLastGID = ((self.obsCount + 19) // 20) * 20 + self.tileLastGID + 1
-
-        f.close()
         
-    def saveVSPFile(self, filename):
+    def saveVSPFile(self, filename, level=datastream.DEFAULT_COMPRESSION_LEVEL):
         self.filename = filename
         try:
-            f = datastream.DataOutputStream(file(filename, 'wb'))
-        except IOError:
+            f = datastream.DataOutputStream(datastream.AtomicFile(filename))
+        except EnvironmentError:
             raise FormatException('The VSP file \'' + filename + '\' could not be opened for writing!')
-        f.writeInt(VSP_SIGNATURE)
-        f.writeInt(VSP_VERSION)
-        f.writeInt(16) # tilesize
-        f.writeInt(1) # format
-        f.writeInt(self.tileCount)
-        f.writeInt(1) # compression
-        f.writeCompressed(struct.pack('<' + str(self.tileCount * 16 * 16 * 3) + 'B', *self.tilePixels))
-        f.writeInt(len(self.animation))
-        for anim in self.animation:
-            anim.writeToVSP(f)
-        self.obs = []
-        f.writeInt(self.obsCount)
-        f.writeCompressed(struct.pack('<' + str(self.obsCount * 16 * 16) + 'B', *self.obsPixels))
-        f.close()
-        
+
+        with f:
+            f.writeInt(VSP_SIGNATURE)
+            f.writeInt(VSP_VERSION)
+            f.writeInt(16) # tilesize
+            f.writeInt(1) # format
+            f.writeInt(self.tileCount)
+            f.writeInt(1) # compression
+            # Both sections get compressed at once.
+            tileData, obsData = datastream.compressAll([self.tilePixels, self.obsPixels], level)
+            f.writeCompressedSection(len(self.tilePixels), tileData)
+            f.writeInt(len(self.animation))
+            ANIMATION_RECORD.write(f, [anim.toRecord() for anim in self.animation])
+            self.obs = []
+            f.writeInt(self.obsCount)
+            f.writeCompressedSection(len(self.obsPixels), obsData)
         
     def dumpTiles(self):
-        pixels = self.tilePixels
-        tileImage = PIL.Image.new('RGBA', (20 * 16, (self.tileCount // 20 + 1) * 16))
-        
-        image = tileImage.load()
-        for tile in range(self.tileCount):
-            y, x = tile // 20 * 16, tile % 20 * 16
-            for i in range(16 * 16):
-                idx = tile * 16 * 16 + i
-                r, g, b = struct.unpack('<BBB', pixels[idx * 3 : idx * 3 + 3])
-                a = 255
-                if r == 255 and g == 0 and b == 255:
-                    a = 0
-                image[x + i % 16, y + i / 16] = (r, g, b, a)
+        rows = getTileSheetRows(self.tileCount)
+        sheet = arrangeTileSheet(self.tilePixels, self.tileCount, 3)
+        tileImage = colorKeyImage(PIL.Image.frombuffer('RGB', (20 * 16, rows * 16), sheet, 'raw', 'RGB', 0, 1))
+        # Past the last tile, the sheet stays fully transparent.
+        tileImage.paste((0, 0, 0, 0), (self.tileCount % 20 * 16, self.tileCount // 20 * 16, 20 * 16, rows * 16))
         tileImage.save(self.filename + self.tileImageName, 'PNG')
         print('    Saved to \'' + self.filename + self.tileImageName + '\'.')
         
     def dumpObs(self):
-        pixels = self.obsPixels
-        obsImage = PIL.Image.new('RGBA', (20 * 16, (self.obsCount // 20 + 1) * 16))
-        
-        image = obsImage.load()
-        for tile in range(self.obsCount):
-            y, x = tile // 20 * 16, tile % 20 * 16
-            for i in range(16 * 16):
-                idx = tile * 16 * 16 + i
-                pixel, = struct.unpack('<B', pixels[idx])
-                pixel = pixel and (255, 255, 255, 127) or (0, 0, 0, 0)
-                image[x + i % 16, y + i / 16] = pixel
+        rows = getTileSheetRows(self.obsCount)
+        sheet = arrangeTileSheet(self.obsPixels, self.obsCount, 1)
+        obsImage = obsMaskImage(PIL.Image.frombuffer('L', (20 * 16, rows * 16), sheet, 'raw', 'L', 0, 1))
         obsImage.save(self.filename + self.obsImageName, 'PNG')
         print('    Saved to \'' + self.filename + self.obsImageName + '\'.')
         
@@ -201,62 +406,44 @@ class VSP(object):
             node.set('name', str(anim.name))
             node.set('tile_begin', str(anim.start))
             node.set('tile_end', str(anim.end))
-            node.set('tile_end', str(anim.delay))
-            node.setAttribute('mode', str(anim.mode))
-        tree = etree.ElementTree(root)
+            node.set('delay', str(anim.delay))
+            node.set('mode', str(anim.mode))
+        tree = etree.ElementTree(animations)
         return tree
 
     def buildFromExternal(self, tileFile, obsFile, animFile=None):
+        self.tileImageCache.clear()
         try:
-            img = PIL.Image.open(tileFile)
+            img = PIL.Image.open(tileFile).convert('RGBA')
         except:
-            raise FormatException('Failure attempting to load ' + filename + '.')
+            raise FormatException('Failure attempting to load ' + tileFile + '.')
         w, h = img.size
         if w % 16 or h % 16:
             raise FormatException('The tile image file \'' + tileFile + '\' has invalid size ' + str(w) + 'x' + str(h) + '! Must be multiples of 16 in size.')
-        pixels = img.load() 
         self.tileCount = (w // 16) * (h // 16)
-        tilePixels = []
-        for t in range(self.tileCount): 
-            x = t * 16 % w
-            y = t * 16 // w * 16
-            for j in range(16):
-                for i in range(16):
-                    p = pixels[x + i, y + j]
-                    if p[3] < 255:
-                        tilePixels.append(255)
-                        tilePixels.append(0)
-                        tilePixels.append(255)
-                    else:
-                        tilePixels.append(p[0])
-                        tilePixels.append(p[1])
-                        tilePixels.append(p[2])
-        self.tilePixels = tilePixels
+        # Anything that isn't fully opaque is replaced by the #ff00ff color key.
+        opaque = img.split()[3].point(MATCH_255)
+        rgb = PIL.Image.composite(img.convert('RGB'), PIL.Image.new('RGB', img.size, (255, 0, 255)), opaque)
+        self.tilePixels = splitTileSheet(getImageBytes(rgb), w, h, 3)
         
         try:
-            img = PIL.Image.open(obsFile)
+            img = PIL.Image.open(obsFile).convert('RGBA')
         except:
-            raise FormatException('Failure attempting to load ' + filename + '.')
+            raise FormatException('Failure attempting to load ' + obsFile + '.')
         w, h = img.size
         if w % 16 or h % 16:
             raise FormatException('The obstruction image file \'' + obsFile + '\' has invalid size ' + str(w) + 'x' + str(h) + '! Must be multiples of 16 in size.')
-        pixels = img.load() 
         self.obsCount = (w // 16) * (h // 16)
-        obsPixels = []
-        for t in range(self.obsCount): 
-            x = t * 16 % w
-            y = t * 16 // w * 16
-            for j in range(16):
-                for i in range(16):
-                    obsPixels.append((pixels[x + i, y + j][3] != 0) and 1 or 0)
-        self.obsPixels = obsPixels
+        # Any pixel that isn't fully transparent is an obstruction.
+        self.obsPixels = splitTileSheet(getImageBytes(img.split()[3].point(NONZERO_1)), w, h, 1)
+        self.updateGIDs()
         
         self.animation = []
         if animFile:
             try:
                 animations = etree.parse(animFile).getroot()
             except:
-                raise FormatException('Failure attempting to parse ' + filename + '.')
+                raise FormatException('Failure attempting to parse ' + animFile + '.')
             i = 0
             
             try:
@@ -274,33 +461,480 @@ class VSP(object):
             except FormatException as e:
                 raise FormatException('Animation file \'' + str(animFile) + '\' contains an invalid animation: ' + str(e))
 
-class Layer(object):
+    def getAnimatedTiles(self):
+        # The index of every tile within an animation.
+        tiles = set()
+        for anim in self.animation:
+            tiles.update(xrange(min(anim.start, anim.end), max(anim.start, anim.end) + 1))
+        return tiles
+        
+    def keepTiles(self, tiles, tileRemap, obs, obsRemap):
+        # Rebuild the tileset out of just the given tiles and obstruction tiles, in the order given.
+        # The remap tables give the new index of every old tile, and are used to rebase the animations.
+        size = VSP_TILESIZE * VSP_TILESIZE
+        oldTileCount = self.tileCount
+        self.tilePixels = selectTiles(self.tilePixels, tiles, size * 3)
+        self.tileCount = len(tiles)
+        self.obsPixels = selectTiles(self.obsPixels, obs, size)
+        self.obsCount = len(obs)
+        def rebase(index):
+            # Animations that run past the end of the tileset just move along with its end.
+            if 0 <= index < len(tileRemap):
+                return tileRemap[index]
+            return index - oldTileCount + self.tileCount
+        for anim in self.animation:
+            anim.start = rebase(anim.start)
+            anim.end = rebase(anim.end)
+        self.tileImageCache.clear()
+        self.updateGIDs()
+        
+    def dedup(self):
+        # Drop repeated tiles and obstruction tiles, keeping the first copy of each.
+        # Animated tiles always stay, since an animation plays through a run of consecutive tiles, and nothing gets merged into them.
+        # The same goes for tile 0 unless it's entirely transparent, since the engine doesn't draw tile 0 on any layer but the first.
+        # Returns (tileRemap, obsRemap), which give the new index of every old tile, to renumber the maps that use this tileset.
+        size = VSP_TILESIZE * VSP_TILESIZE
+        pinned = self.getAnimatedTiles()
+        if self.tileCount and str(self.tile(0)) != '\xff\x00\xff' * size:
+            pinned.add(0)
+        tiles, tileRemap = dedupTiles(self.tilePixels, self.tileCount, size * 3, pinned)
+        obs, obsRemap = dedupTiles(self.obsPixels, self.obsCount, size)
+        self.keepTiles(tiles, tileRemap, obs, obsRemap)
+        return tileRemap, obsRemap
+
+    def prune(self, used):
+        # Drop every tile that isn't in used (a set of tile indices), other than animated tiles, and tile 0, which the engine treats as empty.
+        # Obstruction tiles are left alone. Returns (tileRemap, obsRemap) like dedup() does. Dropped tiles are remapped to 0.
+        keep = used | self.getAnimatedTiles() | set([0])
+        tiles = [i for i in xrange(self.tileCount) if i in keep]
+        tileRemap = [0] * self.tileCount
+        for index, i in enumerate(tiles):
+            tileRemap[i] = index
+        obs = range(self.obsCount)
+        self.keepTiles(tiles, tileRemap, obs, obs)
+        return tileRemap, obs
+
+def mergeVSPs(vsps, dedup=False):
+    # Combine several VSPs into one, with the tiles, obstruction tiles and animations of each following those of the one before.
+    # With dedup, repeated tiles are then dropped, the same way VSP.dedup() does.
+    # Returns the merged VSP, and for each of the VSPs, (tileRemap, obsRemap) tables with the index each of its tiles ended up at.
+    merged = VSP()
+    remaps = []
+    for vsp in vsps:
+        remaps.append((range(merged.tileCount, merged.tileCount + vsp.tileCount), range(merged.obsCount, merged.obsCount + vsp.obsCount)))
+        for anim in vsp.animation:
+            merged.animation.append(Animation(name=anim.name, start=anim.start + merged.tileCount, end=anim.end + merged.tileCount,
+                delay=anim.delay, mode=anim.mode))
+        merged.tileCount += vsp.tileCount
+        merged.obsCount += vsp.obsCount
+    for i, anim in enumerate(merged.animation):
+        anim.id = i
+    size = VSP_TILESIZE * VSP_TILESIZE
+    merged.tilePixels = ''.join([vsp.tilePixels[: vsp.tileCount * size * 3] for vsp in vsps])
+    merged.obsPixels = ''.join([vsp.obsPixels[: vsp.obsCount * size] for vsp in vsps])
+    merged.updateGIDs()
+    if dedup:
+        tileRemap, obsRemap = merged.dedup()
+        remaps = [([tileRemap[i] for i in tiles], [obsRemap[i] for i in obs]) for tiles, obs in remaps]
+    # Maps store tile and obstruction indices in arrays of TILE_TYPECODE and OBS_TYPECODE, so the merged tileset has to fit those.
+    for count, typecode, kind in ((merged.tileCount, TILE_TYPECODE, 'tiles'), (merged.obsCount, OBS_TYPECODE, 'obstruction tiles')):
+        limit = 2 ** (array.array(typecode).itemsize * 8)
+        if count > limit:
+            raise FormatException('The merged tileset would have ' + str(count) + ' ' + kind + '. Maps can only use up to ' + str(limit) + '.')
+    return merged, remaps
+
+class VSPRegistry(object):
+    # Loaded VSPs, shared between all the maps that use them, so a batch of maps over the same few tilesets
+    # only loads (and converts) each tileset once. Entries are keyed by normalized path, file size and
+    # modification time, so a VSP that changes on disk gets loaded again.
+    # With a capacity (in bytes of pixel data), the least recently used VSPs are dropped to stay under it.
+    def __init__(self, capacity=None):
+        self.cache = LRUCache(capacity, lambda vsp: len(vsp.tilePixels) + len(vsp.obsPixels))
+        # path -> the current key for that path, so stale versions of a file can be dropped.
+        self.keys = {}
+        self.dumped = set()
+        
+    def getKey(self, filename):
+        path = os.path.normcase(os.path.realpath(filename))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise FormatException('VSP file \'' + filename + '\' was not found.')
+        return path, stat.st_size, stat.st_mtime
+        
+    def load(self, filename):
+        key = self.getKey(filename)
+        vsp = self.cache.get(key)
+        if vsp is None:
+            vsp = VSP()
+            vsp.loadVSPFile(filename)
+            path = key[0]
+            if path in self.keys:
+                self.cache.remove(self.keys[path])
+            self.keys[path] = key
+            self.cache.put(key, vsp)
+        return vsp
+        
+    def claimDump(self, filename):
+        # True the first time this is asked about a VSP (as it is on disk right now), and False after that,
+        # so its tile, obstruction and animation files only get written once per run.
+        key = self.getKey(filename)
+        if key in self.dumped:
+            return False
+        self.dumped.add(key)
+        return True
+        
+    def setCapacity(self, capacity):
+        self.cache.setCapacity(capacity)
+        
+    def clear(self):
+        self.cache.clear()
+        self.keys = {}
+        self.dumped = set()
+
+# The VSPs loaded by Map.loadMapFile.
+VSP_REGISTRY = VSPRegistry()
+
+# Typecodes for the compact arrays that hold the map grids, matching the widths used by the .map format.
+TILE_TYPECODE = 'H'
+OBS_TYPECODE = 'B'
+ZONE_TYPECODE = 'H'
+
+# The ways layer data can be stored in a .tmx.
+TMX_ENCODING_XML = 'xml' # one <tile gid='N'/> element per cell
+TMX_ENCODING_ZLIB = 'zlib' # base64'd zlib'd 32-bit integers
+TMX_ENCODING_GZIP = 'gzip' # base64'd gzip'd 32-bit integers
+TMX_ENCODING_CSV = 'csv' # comma-separated values, one line per row
+# The encodings which are base64'd compressed data. The compression has the same name as the encoding.
+TMX_COMPRESSED_ENCODINGS = (TMX_ENCODING_ZLIB, TMX_ENCODING_GZIP)
+
+# Suggested size (in tiles, each way) of the <chunk> elements layers get split into when exporting chunked maps.
+TMX_DEFAULT_CHUNK_SIZE = 64
+
+# Tiled keeps a tile's flipped and rotated state in the top three bits of its GID. The .map format can't flip tiles,
+# so those bits are cleared when reading. Otherwise, a GID is an unsigned 32-bit number.
+TMX_FLIP_BITS = 0xE0000000
+TMX_MAX_GID = 0xFFFFFFFF
+
+def asNumpy(values):
+    # Wrap an array without copying it, where possible.
+    if isinstance(values, array.array):
+        return numpy.frombuffer(values, values.typecode)
+    return numpy.asarray(values)
+
+def decodeGIDs(text, compression=TMX_ENCODING_ZLIB):
+    # Unpack base64'd zlib'd (or gzip'd) little-endian 32-bit GIDs into an array('i').
+    try:
+        data = base64.b64decode(text)
+    except TypeError as e:
+        raise FormatException('Layer data is not valid base64: ' + str(e))
+    if compression == TMX_ENCODING_GZIP:
+        data = datastream.gzipDecompress(data)
+    else:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as e:
+            raise FormatException('Layer data is corrupt: ' + str(e))
+    gids = array.array('i')
+    gids.fromstring(data)
+    if sys.byteorder == 'big':
+        gids.byteswap()
+    return clearFlipBits(gids)
+
+def encodeGIDs(gids, compression=TMX_ENCODING_ZLIB, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+    # The reverse of decodeGIDs.
+    if sys.byteorder == 'big':
+        gids = array.array('i', gids)
+        gids.byteswap()
+    if compression == TMX_ENCODING_GZIP:
+        return base64.b64encode(datastream.gzipCompress(gids.tostring(), level))
+    return base64.b64encode(datastream.compress(gids.tostring(), level))
+
+def clearFlipBits(gids):
+    # GIDs (an array('i'), a numpy array of int64, or a list of numbers from 0 to TMX_MAX_GID) as an array('i'),
+    # with Tiled's flip bits cleared.
+    if numpy is not None:
+        values = asNumpy(gids).astype(numpy.int64) & ~TMX_FLIP_BITS
+        result = array.array('i')
+        result.fromstring(values.astype(numpy.int32).tostring())
+        return result
+    return array.array('i', [gid & ~TMX_FLIP_BITS for gid in gids])
+
+def fromGIDList(values):
+    # GIDs given as plain numbers (from CSV, <tile> elements or a Tiled JSON array) as an array('i'), with the flip bits cleared.
+    # Anything that isn't a whole number from 0 to TMX_MAX_GID is an error.
+    if not len(values):
+        return array.array('i')
+    if numpy is not None:
+        gids = numpy.asarray(values)
+        # Numbers too large for int64 end up as objects, and anything that isn't a number as something other than integers.
+        if gids.dtype.kind not in 'iu':
+            raise FormatException('Layer data has something that isn\'t a valid GID.')
+        gids = gids.astype(numpy.int64)
+        if gids.min() < 0 or gids.max() > TMX_MAX_GID:
+            raise FormatException('GID ' + str(gids.max() > TMX_MAX_GID and gids.max() or gids.min()) + ' is out of range. Must be from 0 to ' + str(TMX_MAX_GID) + '.')
+        return clearFlipBits(gids)
+    for gid in values:
+        if type(gid) not in (int, long):
+            raise FormatException('Layer data has something that isn\'t a valid GID: ' + repr(gid) + '.')
+        if not 0 <= gid <= TMX_MAX_GID:
+            raise FormatException('GID ' + str(gid) + ' is out of range. Must be from 0 to ' + str(TMX_MAX_GID) + '.')
+    return clearFlipBits(values)
+
+def decodeCSVGIDs(text):
+    # Unpack comma-separated GIDs (line breaks and other whitespace are allowed around the commas) into an array('i').
+    # A trailing comma is allowed, but every item has to be a single number.
+    text = text.strip()
+    if text.endswith(','):
+        text = text[:-1]
+    if not text:
+        return array.array('i')
+    items = [item.strip() for item in text.split(',')]
+    # Checking them all at once is much faster than one at a time, which is only needed to say which one is bad.
+    if not ''.join(items).isdigit() or '' in items or max(map(len, items)) > len(str(TMX_MAX_GID)):
+        for i, item in enumerate(items):
+            if not item.isdigit():
+                raise FormatException('Layer data is not valid CSV. Item #' + str(i + 1) + ' (' + repr(item) + ') is not a number.')
+            if len(item) > len(str(TMX_MAX_GID)):
+                raise FormatException('GID ' + item + ' is out of range. Must be from 0 to ' + str(TMX_MAX_GID) + '.')
+    if numpy is not None:
+        # Every item is known to be a number that fits, so numpy reads all of them.
+        return fromGIDList(numpy.fromstring(text, numpy.int64, sep=','))
+    return fromGIDList(map(int, items))
+
+def encodeCSVGIDs(gids, width):
+    # The reverse of decodeCSVGIDs, laid out like Tiled does: one line per row, each ending with a comma except the last.
+    return '\n' + ',\n'.join([','.join(map(str, gids[i : i + width])) for i in xrange(0, len(gids), width)]) + '\n'
+
+def splitChunks(gids, width, height, size):
+    # Cut a width x height grid of GIDs into size x size chunks, yielding (x, y, gids) in row-major order.
+    # Chunks along the right and bottom edges are padded out with empty cells, since Tiled expects every chunk to be the same size.
+    empty = array.array('i', [0])
+    for y in xrange(0, height, size):
+        for x in xrange(0, width, size):
+            chunk = array.array('i')
+            right = min(x + size, width)
+            for row in xrange(y, min(y + size, height)):
+                chunk.extend(gids[row * width + x : row * width + right])
+                chunk.extend(empty * (x + size - right))
+            chunk.extend(empty * (size * size - len(chunk)))
+            yield x, y, chunk
+
+def joinChunks(chunks, width, height):
+    # The reverse of splitChunks. Takes (x, y, chunkWidth, chunkHeight, gids) and gives back a dense width x height grid.
+    # Any cells not covered by a chunk are empty. Chunks may hang off the edges of the map, but only with empty cells.
+    gids = array.array('i', [0]) * (width * height)
+    for x, y, w, h, chunk in chunks:
+        if len(chunk) != w * h:
+            raise FormatException('Chunk at ' + str(x) + ', ' + str(y) + ' does not contain exactly ' + str(w * h) + ' tiles.')
+        left = min(max(x, 0), width)
+        right = max(min(x + w, width), left)
+        for row in xrange(h):
+            line = chunk[row * w : (row + 1) * w]
+            if 0 <= y + row < height:
+                part = line[left - x : right - x]
+                gids[(y + row) * width + left : (y + row) * width + right] = part
+            else:
+                part = line[:0]
+            if line.count(0) - part.count(0) != len(line) - len(part):
+                raise FormatException('Chunk at ' + str(x) + ', ' + str(y) + ' has tiles outside of the ' + str(width) + 'x' + str(height) + ' map.')
+    return gids
+
+def encodeGrids(grids, encoding, chunkSize=0, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+    # Prepares the data of several (gids, width, height) grids for a Tiled export. For zlib or gzip, each becomes base64'd compressed
+    # text, and otherwise the GIDs are left as they are. With a chunkSize, each grid becomes a list of (x, y, data) for its non-empty chunks.
+    # All the compression happens at once, spread across datastream's compression threads.
+    encode = lambda gids: encodeGIDs(gids, encoding, level)
+    if chunkSize:
+        # Empty cells are 0, so an all-zero chunk can be skipped. (The first layer never has any.)
+        grids = [[(x, y, chunk) for x, y, chunk in splitChunks(gids, width, height, chunkSize) if chunk.count(0) != len(chunk)]
+            for gids, width, height in grids]
+        if encoding in TMX_COMPRESSED_ENCODINGS:
+            encoded = iter(datastream.parallelMap(encode, [chunk for chunks in grids for x, y, chunk in chunks]))
+            grids = [[(x, y, next(encoded)) for x, y, chunk in chunks] for chunks in grids]
+        return grids
+    grids = [gids for gids, width, height in grids]
+    if encoding in TMX_COMPRESSED_ENCODINGS:
+        return datastream.parallelMap(encode, grids)
+    return grids
+
+def readTiledJSONData(layer, count):
+    # Get the GIDs out of a Tiled JSON tile layer (or chunk), where 'data' is either an array of numbers, or a base64 string.
+    data = layer.get('data')
+    if type(data) == list:
+        gids = fromGIDList(data)
+    elif isinstance(data, basestring) and layer.get('encoding') == 'base64' and layer.get('compression') in TMX_COMPRESSED_ENCODINGS:
+        gids = decodeGIDs(data, layer.get('compression'))
+    else:
+        raise FormatException('Cannot parse layers with ' + str(layer.get('encoding')) + ' encoding and ' + str(layer.get('compression')) + ' compression.')
+    if len(gids) != count:
+        raise FormatException('Layer does not contain exactly ' + str(count) + ' tiles.')
+    return gids
+
+def readLayerData(node, width, height, chunked=False):
+    # Get the GIDs out of a tile layer from either a .tmx or a Tiled JSON document.
+    # Layers of chunked (infinite) maps are stitched back together into a dense width x height grid.
+    if type(node) == dict:
+        if node.get('chunks') is not None:
+            chunks = []
+            for chunk in node.get('chunks'):
+                w = getIntegerNode(chunk, 'width')
+                h = getIntegerNode(chunk, 'height')
+                # Chunks inherit the layer's encoding.
+                chunk = dict(chunk, encoding=node.get('encoding'), compression=node.get('compression'))
+                chunks.append((getIntegerNode(chunk, 'x'), getIntegerNode(chunk, 'y'), w, h, readTiledJSONData(chunk, w * h)))
+            return joinChunks(chunks, width, height)
+        if node.get('data') is None:
+            raise FormatException('Missing data.')
+        return readTiledJSONData(node, width * height)
+    data = node.find('data')
+    if data == None:
+        raise FormatException('Missing <data> tag.')
+    if chunked:
+        chunks = []
+        for chunk in data.iter('chunk'):
+            w = getIntegerNode(chunk, 'width')
+            h = getIntegerNode(chunk, 'height')
+            chunks.append((getIntegerNode(chunk, 'x'), getIntegerNode(chunk, 'y'), w, h, readTiledData(data, w * h, chunk)))
+        return joinChunks(chunks, width, height)
+    return readTiledData(data, width * height)
+
+def readTiledData(data, count, node=None):
+    # Get the GIDs out of a layer's <data>, which holds either base64'd zlib'd (or gzip'd) 32-bit integers, comma-separated values,
+    # or one <tile gid='N'/> per cell. For chunked maps, the contents are in a <chunk> node instead,
+    # but the encoding is still given by the <data>.
+    if node is None:
+        node = data
+    if data.get('encoding') or data.get('compression'):
+        if data.get('encoding') == 'base64' and data.get('compression') in TMX_COMPRESSED_ENCODINGS:
+            gids = decodeGIDs(str(node.text).strip(), data.get('compression'))
+        elif data.get('encoding') == 'csv' and not data.get('compression'):
+            gids = decodeCSVGIDs(str(node.text))
+        else:
+            raise FormatException('Cannot parse layers with ' + str(data.get('encoding')) + ' encoding and ' + str(data.get('compression')) + ' compression.')
+    else:
+        try:
+            gids = fromGIDList([int(t.get('gid', '0')) for t in node.iter('tile')])
+        except ValueError as e:
+            raise FormatException('A <tile> has a gid that isn\'t a number: ' + str(e))
+    if len(gids) != count:
+        raise FormatException('Layer does not contain exactly ' + str(count) + ' tiles.')
+    return gids
+
+def fromGIDs(gids, firstGID, typecode):
+    # Turn GIDs into indices relative to firstGID, in a compact array of the given typecode.
+    # Empty cells (and anything else before firstGID) become 0.
+    limit = 2 ** (array.array(typecode).itemsize * 8) - 1
+    if numpy is not None:
+        values = asNumpy(gids).astype(numpy.int64) - firstGID
+        numpy.maximum(values, 0, values)
+        if len(values) and values.max() > limit:
+            raise FormatException('Tile index ' + str(values.max()) + ' is too large. Must be at most ' + str(limit) + '.')
+        result = array.array(typecode)
+        result.fromstring(values.astype(numpy.dtype(typecode)).tostring())
+        return result
+    values = [max(t - firstGID, 0) for t in gids]
+    if values and max(values) > limit:
+        raise FormatException('Tile index ' + str(max(values)) + ' is too large. Must be at most ' + str(limit) + '.')
+    return array.array(typecode, values)
+
+def toGIDs(values, firstGID, keepEmpty=False):
+    # The reverse of fromGIDs, producing an array('i'). With keepEmpty, index 0 becomes GID 0 (an empty cell).
+    if numpy is not None:
+        indices = asNumpy(values)
+        gids = indices.astype(numpy.int32) + firstGID
+        if keepEmpty:
+            gids[indices == 0] = 0
+        result = array.array('i')
+        result.fromstring(gids.tostring())
+        return result
+    if keepEmpty:
+        return array.array('i', [t and t + firstGID for t in values])
+    return array.array('i', [t + firstGID for t in values])
+
+def remapValues(values, table, typecode, keepEmpty=False):
+    # Look up every value in a remap table, giving an array of the given typecode. With keepEmpty, 0 stays 0.
+    limit = 2 ** (array.array(typecode).itemsize * 8) - 1
+    if len(table) and max(table) > limit:
+        raise FormatException('Index ' + str(max(table)) + ' is too large. Must be at most ' + str(limit) + '.')
+    if numpy is not None:
+        indices = asNumpy(values)
+        if len(indices) and indices.max() >= len(table):
+            raise FormatException('Index ' + str(indices.max()) + ' is out of range. There are only ' + str(len(table)) + '.')
+        remapped = numpy.asarray(table, numpy.dtype(typecode))[indices]
+        if keepEmpty:
+            remapped[indices == 0] = 0
+        result = array.array(typecode)
+        result.fromstring(remapped.tostring())
+        return result
+    if len(values) and max(values) >= len(table):
+        raise FormatException('Index ' + str(max(values)) + ' is out of range. There are only ' + str(len(table)) + '.')
+    if keepEmpty:
+        return array.array(typecode, [v and table[v] for v in values])
+    return array.array(typecode, [table[v] for v in values])
+
+def countValues(values, count):
+    # A histogram of an array of indices, counting how many times each index from 0 to count - 1 appears.
+    # If there are indices past that, the histogram is longer, to cover them.
+    if numpy is not None:
+        return numpy.bincount(asNumpy(values), minlength=count).tolist()
+    counts = [0] * count
+    if len(values) and max(values) >= count:
+        counts += [0] * (max(values) + 1 - count)
+    for v in values:
+        counts[v] += 1
+    return counts
+
+def getTiledLayout(node, chunked=False):
+    # The encoding (one of TMX_ENCODING_*) and chunk size (or 0) of a tile layer in a .tmx or Tiled JSON document,
+    # so that the document can be written back the same way.
+    if type(node) == dict:
+        data = node
+        chunks = node.get('chunks')
+        chunk = chunks and chunks[0] or None
+    else:
+        data = node.find('data')
+        if data is None:
+            return TMX_ENCODING_XML, 0
+        chunk = data.find('chunk')
+    chunkSize = chunk is not None and getIntegerNode(chunk, 'width') or (chunked and TMX_DEFAULT_CHUNK_SIZE or 0)
+    if data.get('compression') in TMX_COMPRESSED_ENCODINGS:
+        return data.get('compression'), chunkSize
+    if data.get('encoding') == 'csv':
+        return TMX_ENCODING_CSV, chunkSize
+    return TMX_ENCODING_XML, chunkSize
+
+class Layer(LazyAttributes):
     def __init__(self):
         self.id = -1
         
     def readFromMap(self, f):
+        self.readHeaderFromMap(f)
+        self.data = f.readCompressedArray(TILE_TYPECODE, self.width * self.height)
+        
+    def readHeaderFromMap(self, f):
+        # Everything but the tile data.
         self.name = f.readFixedString(256)
         self.parallaxX = f.readDouble()
         self.parallaxY = f.readDouble()
         self.width = f.readShort()
         self.height = f.readShort()
-        self.data = [0] * (self.width * self.height)
         self.alpha = 1 - float(f.readUnsignedByte()) / 100.0
-        
-        layerdata = f.readCompressed()
-        for i in range(len(layerdata) / 2):
-            self.data[i], = struct.unpack('<H', layerdata[i * 2 : i * 2 + 2])
             
     def writeToMap(self, f):
+        self.writeHeaderToMap(f)
+        f.writeCompressedArray(self.data, TILE_TYPECODE)
+        
+    def writeHeaderToMap(self, f):
+        # Everything but the tile data.
         f.writeFixedString(self.name, 256)
         f.writeDouble(self.parallaxX)
         f.writeDouble(self.parallaxY)
         f.writeShort(self.width)
         f.writeShort(self.height)
         f.writeUnsignedByte(100 - int(self.alpha * 100.0 + 0.5))
-        f.writeCompressed(struct.pack('<' + str(self.width * self.height) + 'H', *self.data))
 
-    def convertFromTiled(self, node):
+    def convertFromTiled(self, node, chunked=False):
         self.name = node.get('name', '')
         self.width = getIntegerNode(node, 'width')
         self.height = getIntegerNode(node, 'height')
@@ -309,21 +943,15 @@ class Layer(object):
         self.id = getIntegerNode(props, 'id')
         self.parallaxX = getNumericNode(props, 'parallax_x', 1.0)
         self.parallaxY = getNumericNode(props, 'parallax_y', 1.0)
-        data = node.find('data')
-        if data != None:
-            if data.get('encoding') or data.get('compression'):
-                if data.get('encoding') == 'base64' and data.get('compression') == 'zlib':
-                    # Convert base64'd zlib'd chunk of 32-bit integers into a list of ints [max(N - 1, 0)...].
-                    self.data = [max(t - 1, 0) for t in struct.unpack('<' + str(self.width * self.height) + 'i', zlib.decompress(base64.b64decode(str(data.text))))]
-                else:
-                    raise FormatException('Cannot parse layers with ' + str(data.get('encoding')) + ' encoding and ' + str(data.get('compression')) + ' compression.')
-            else:
-                # Convert <tile gid='N'/>... into a list of ints [max(N - 1, 0)...].
-                self.data = [max(int(t.get('gid', '1')) - 1, 0) for t in data.iter('tile')]
-                if len(self.data) != self.width * self.height:
-                    raise FormatException('Layer does not contain exactly ' + str(self.width * self.height) + ' tiles in a layer that is ' + str(self.width) + 'x' + str(self.height) + ' in size.')
-        else:
-            raise FormatException('Mising <data> tag.')
+        # Convert the GIDs into a list of ints [max(N - 1, 0)...].
+        self.data = fromGIDs(readLayerData(node, self.width, self.height, chunked), 1, TILE_TYPECODE)
+        
+    def toTiledProperties(self):
+        return [
+            ('id', str(self.id)),
+            ('parallax_x', str(self.parallaxX)),
+            ('parallax_y', str(self.parallaxY)),
+        ]
 
 class Zone(object):
     def __init__(self):
@@ -335,18 +963,26 @@ class Zone(object):
         self.method = 1
     
     def readFromMap(self, f):
-        self.name = f.readFixedString(256)
-        self.activationEvent = f.readFixedString(256)
-        self.chance = f.readUnsignedByte()
-        self.delay = f.readUnsignedByte()
-        self.method = f.readUnsignedByte()
+        self.fromRecord(ZONE_RECORD.read(f, 1)[0])
         
     def writeToMap(self, f):
-        f.writeFixedString(self.name, 256)
-        f.writeFixedString(self.activationEvent, 256)
-        f.writeUnsignedByte(self.chance)
-        f.writeUnsignedByte(self.delay)
-        f.writeUnsignedByte(self.method)
+        ZONE_RECORD.write(f, [self.toRecord()])
+        
+    def fromRecord(self, record):
+        self.name = record['name']
+        self.activationEvent = record['activationEvent']
+        self.chance = record['chance']
+        self.delay = record['delay']
+        self.method = record['method']
+        
+    def toRecord(self):
+        return {
+            'name': self.name,
+            'activationEvent': self.activationEvent,
+            'chance': self.chance,
+            'delay': self.delay,
+            'method': self.method,
+        }
         
     def convertFromTiled(self, node):
         props = getProperties(node)
@@ -355,7 +991,23 @@ class Zone(object):
         self.chance = getIntegerNode(props, 'activation_chance', 255)
         self.delay = getIntegerNode(props, 'activation_delay', 0)
         self.method = props.get('allow_adjacent') == 'true' and 1 or 0
+        
+    def toTiledProperties(self):
+        return [
+            ('name', self.name),
+            ('allow_adjacent', str(self.method and 'true' or 'false')),
+            ('activation_event', str(self.activationEvent)),
+            ('activation_chance', str(self.chance)),
+            ('activation_delay', str(self.delay)),
+        ]
 
+ZONE_RECORD = RecordSchema(
+    ('name', '256s'),
+    ('activationEvent', '256s'),
+    ('chance', 'B'),
+    ('delay', 'B'),
+    ('method', 'B'),
+)
 
 ENTITY_DIR = {
     '0': 'north',
@@ -384,46 +1036,50 @@ class Entity(object):
         self.id = -1
         
     def readFromMap(self, f):
-        self.x = f.readShort()
-        self.y = f.readShort()
-        self.direction = ENTITY_DIR.get(f.readByte(), 'south')
-        self.isObstructable = f.readByte()
-        self.isObstruction = f.readByte()
-        self.autoface = f.readByte()
-        self.speed = f.readShort()
-        crap = f.readByte() # unused activation mode
-        self.movementMode = ENTITY_MOVEMENT.get(str(f.readByte()), 'none')        
-        self.wanderX1 = f.readShort() 
-        self.wanderY1 = f.readShort()
-        self.wanderX2 = f.readShort() 
-        self.wanderY2 = f.readShort()
-        self.wanderDelay = f.readShort()
-        crap = f.readInt() # unused 'expand' flag
-        self.movescript = f.readFixedString(256)
-        self.filename = f.readFixedString(256)
-        self.description = f.readFixedString(256)
-        self.activationEvent = f.readFixedString(256)
+        self.fromRecord(ENTITY_RECORD.read(f, 1)[0])
         
     def writeToMap(self, f):
-        f.writeShort(self.x)
-        f.writeShort(self.y)
-        f.writeByte(ENTITY_DIR_OUT[self.direction])
-        f.writeByte(self.isObstructable)
-        f.writeByte(self.isObstruction)
-        f.writeByte(self.autoface)
-        f.writeShort(self.speed)
-        f.writeByte(0) # unused activation mode
-        f.writeByte(ENTITY_MOVEMENT_OUT[self.movementMode])
-        f.writeShort(self.wanderX1)
-        f.writeShort(self.wanderY1)
-        f.writeShort(self.wanderX2)
-        f.writeShort(self.wanderY2)
-        f.writeShort(self.wanderDelay)
-        f.writeInt(0) # unused expand flag
-        f.writeFixedString(self.movescript, 256)
-        f.writeFixedString(self.filename, 256)
-        f.writeFixedString(self.description, 256)
-        f.writeFixedString(self.activationEvent, 256)
+        ENTITY_RECORD.write(f, [self.toRecord()])
+        
+    def fromRecord(self, record):
+        self.x = record['x']
+        self.y = record['y']
+        self.direction = ENTITY_DIR.get(record['direction'], 'south')
+        self.isObstructable = record['isObstructable']
+        self.isObstruction = record['isObstruction']
+        self.autoface = record['autoface']
+        self.speed = record['speed']
+        self.movementMode = ENTITY_MOVEMENT.get(str(record['movementMode']), 'none')
+        self.wanderX1 = record['wanderX1']
+        self.wanderY1 = record['wanderY1']
+        self.wanderX2 = record['wanderX2']
+        self.wanderY2 = record['wanderY2']
+        self.wanderDelay = record['wanderDelay']
+        self.movescript = record['movescript']
+        self.filename = record['filename']
+        self.description = record['description']
+        self.activationEvent = record['activationEvent']
+        
+    def toRecord(self):
+        return {
+            'x': self.x,
+            'y': self.y,
+            'direction': ENTITY_DIR_OUT[self.direction],
+            'isObstructable': self.isObstructable,
+            'isObstruction': self.isObstruction,
+            'autoface': self.autoface,
+            'speed': self.speed,
+            'movementMode': ENTITY_MOVEMENT_OUT[self.movementMode],
+            'wanderX1': self.wanderX1,
+            'wanderY1': self.wanderY1,
+            'wanderX2': self.wanderX2,
+            'wanderY2': self.wanderY2,
+            'wanderDelay': self.wanderDelay,
+            'movescript': self.movescript,
+            'filename': self.filename,
+            'description': self.description,
+            'activationEvent': self.activationEvent,
+        }
         
     def convertFromTiled(self, node):
         self.x = getIntegerNode(node, 'x') // VSP_TILESIZE
@@ -449,16 +1105,71 @@ class Entity(object):
         self.wanderY2 = getIntegerNode(props, 'wander_y2', 0)
         self.wanderDelay = getIntegerNode(props, 'wander_delay', 0)
         self.movescript = props.get('movescript', '')
+        
+    def toTiledProperties(self):
+        props = [
+            ('id', str(self.id)),
+            ('filename', str(self.filename)),
+            ('direction', str(self.direction)),
+            ('is_obstructable', str(self.isObstruction and 'true' or 'false')),
+            ('is_obstruction', str(self.isObstruction and 'true' or 'false')),
+            ('autoface', str(self.autoface and 'true' or 'false')),
+            ('speed', str(self.speed)),
+            ('movement_mode', str(self.movementMode)),
+        ]
+        if self.movementMode == 'wander_rect':
+            props.append(('wander_x1', str(self.wanderX1)))
+            props.append(('wander_y1', str(self.wanderY1)))
+            props.append(('wander_x2', str(self.wanderX2)))
+            props.append(('wander_y2', str(self.wanderY2)))
+            props.append(('wander_delay', str(self.wanderDelay)))
+        elif self.movementMode == 'wander_zone':
+            props.append(('wander_delay', str(self.wanderDelay)))
+        elif self.movementMode == 'script':
+            props.append(('movescript', str(self.movescript)))
+        props.append(('activation_event', str(self.activationEvent)))
+        return props
 
+ENTITY_RECORD = RecordSchema(
+    ('x', 'h'),
+    ('y', 'h'),
+    ('direction', 'b'),
+    ('isObstructable', 'b'),
+    ('isObstruction', 'b'),
+    ('autoface', 'b'),
+    ('speed', 'h'),
+    (None, 'b'), # unused activation mode
+    ('movementMode', 'b'),
+    ('wanderX1', 'h'),
+    ('wanderY1', 'h'),
+    ('wanderX2', 'h'),
+    ('wanderY2', 'h'),
+    ('wanderDelay', 'h'),
+    (None, 'i'), # unused 'expand' flag
+    ('movescript', '256s'),
+    ('filename', '256s'),
+    ('description', '256s'),
+    ('activationEvent', '256s'),
+)
 
 
 MAP_SIGNATURE = 'V3MAP\0'
 MAP_VERSION = 2
         
-class Map(object):
+class Map(LazyAttributes):
     def __init__(self):
         pass
         
+    @classmethod
+    def open(cls, filename, lazy=True):
+        # Load a .map. When lazy, the layers, obstruction and zone grids, and VSP are only loaded once they're used.
+        map = cls()
+        if lazy:
+            map.scanMapFile(filename)
+        else:
+            map.loadMapFile(filename)
+        return map
+        
     def dumpZoneDummyImage(self):
         font = PIL.ImageFont.load_default()
         zoneCount = len(self.zone)
@@ -473,24 +1184,29 @@ class Map(object):
         image.save(self.zoneDummyFilename, 'PNG')
         print('    Saved to \'' + self.zoneDummyFilename + '\'.')
         
-    def loadMapFile(self, filename):
+    def getVSPPath(self):
+        # The VSP filename is relative to the map.
+        return os.path.join(os.path.dirname(self.filename), self.vspFilename)
+        
+    def openMapFile(self, filename):
         self.filename = filename
         self.zoneDummyFilename = filename + '.zone.png'
         try:
-            f = datastream.DataInputStream(file(filename, 'rb'))
+            return datastream.MappedDataInputStream(file(filename, 'rb'))
         except IOError:
             raise FormatException('The MAP file \'' + filename + '\' was not found.')
-
+        
+    def readHeader(self, f):
         # Header stuff!
         signature = f.read(len(MAP_SIGNATURE))
         version = f.readInt()
 
         # Verify the map has the right signature
         if signature != MAP_SIGNATURE:
-            raise FormatException('The MAP file \'' + filename + '\' has a bad signature of ' + signature)
+            raise FormatException('The MAP file \'' + self.filename + '\' has a bad signature of ' + signature)
         # Verify the map is the right version
         if version != MAP_VERSION:
-            raise FormatException('The MAP file \'' + filename + '\' has a bad version of ' + str(version))
+            raise FormatException('The MAP file \'' + self.filename + '\' has a bad version of ' + str(version))
 
         # Skip vc offset.
         version = f.readInt()
@@ -498,8 +1214,6 @@ class Map(object):
         # String data of various use.
         self.mapName = f.readFixedString(256)
         self.vspFilename = f.readFixedString(256)
-        self.vsp = VSP()
-        self.vsp.loadVSPFile(os.path.dirname(self.filename) + '/' + self.vspFilename)
         self.musicFilename = f.readFixedString(256)
         self.renderOrder = f.readFixedString(256).split(',')
         self.renderItem = {}
@@ -508,472 +1222,732 @@ class Map(object):
         # Starting location. If not specificied in script, use the map's default.
         self.startX = f.readUnsignedShort()
         self.startY = f.readUnsignedShort()
+        
+    def loadMapHeader(self, filename):
+        # Only reads the header (name, VSP filename, music, render order, and so on), for tools that don't need
+        # the layers, zones, entities or VSP.
+        with self.openMapFile(filename) as f:
+            self.readHeader(f)
+        
+    def loadMapFile(self, filename):
+        with self.openMapFile(filename) as f:
+            self.readHeader(f)
+            # The VSP may be shared with other maps, and so shouldn't be modified.
+            self.vsp = VSP_REGISTRY.load(self.getVSPPath())
 
-        # Layers!
-        layerCount = f.readInt()
-        self.layer = []
-        for i in range(layerCount):
-            layer = Layer()
-            layer.id = i
-            layer.readFromMap(f)
-            self.layer.append(layer)
-            self.renderItem[str(layer.id + 1)] = layer
-        self.width = self.layer[0].width
-        self.height = self.layer[0].height
-        self.obsLayer = [i for i in struct.unpack('<' + str(self.width * self.height) + 'B', f.readCompressed())]
-        self.zoneLayer = [i for i in struct.unpack('<' + str(self.width * self.height) + 'H', f.readCompressed())]
-
+            # Layers!
+            layerCount = f.readInt()
+            self.layer = []
+            sections = []
+            for i in range(layerCount):
+                layer = Layer()
+                layer.id = i
+                layer.readHeaderFromMap(f)
+                sections.append(f.readCompressedSection())
+                self.layer.append(layer)
+                self.renderItem[str(layer.id + 1)] = layer
+            self.width = self.layer[0].width
+            self.height = self.layer[0].height
+            sections.append(f.readCompressedSection())
+            sections.append(f.readCompressedSection())
+            self.readZonesAndEntities(f)
+            
+            # Now that everything's been located, inflate all of the sections at once.
+            # Each goes straight into its array.
+            items = [(section, TILE_TYPECODE, layer.width * layer.height) for section, layer in zip(sections, self.layer)]
+            items.append((sections[-2], OBS_TYPECODE, self.width * self.height))
+            items.append((sections[-1], ZONE_TYPECODE, self.width * self.height))
+            data = datastream.decompressArrays(items)
+            for layer, layerData in zip(self.layer, data):
+                layer.data = layerData
+            self.obsLayer, self.zoneLayer = data[-2:]
+            
+    def scanMapFile(self, filename):
+        # Like loadMapFile, but the layers, and obstruction and zone grids are only located, not decompressed.
+        # Each is read from the file the first time it's used, as is the VSP.
+        # self.sections lists (name, offset, uncompressed size, compressed size) for each compressed section.
+        with self.openMapFile(filename) as f:
+            stat = os.fstat(f.file.fileno())
+            self.fileStamp = (stat.st_size, stat.st_mtime)
+            self.readHeader(f)
+            self.setLazy('vsp', lambda: VSP_REGISTRY.load(self.getVSPPath()))
+            self.sections = []
+            
+            layerCount = f.readInt()
+            self.layer = []
+            for i in range(layerCount):
+                layer = Layer()
+                layer.id = i
+                layer.readHeaderFromMap(f)
+                layer.setLazy('data', self.getSectionLoader(f, 'Layer #' + str(i), TILE_TYPECODE, layer.width * layer.height))
+                self.layer.append(layer)
+                self.renderItem[str(layer.id + 1)] = layer
+            if not self.layer:
+                raise FormatException('The MAP file \'' + filename + '\' has no layers.')
+            self.width = self.layer[0].width
+            self.height = self.layer[0].height
+            self.setLazy('obsLayer', self.getSectionLoader(f, 'Obstructions', OBS_TYPECODE, self.width * self.height))
+            self.setLazy('zoneLayer', self.getSectionLoader(f, 'Zones', ZONE_TYPECODE, self.width * self.height))
+            self.readZonesAndEntities(f)
+            
+    def getSectionLoader(self, f, name, typecode, count):
+        # Skips over the compressed section at the current position of f, and returns a function to load it later.
+        offset, uncompressedSize, compressedSize = f.skipCompressed()
+        self.sections.append((name, offset, uncompressedSize, compressedSize))
+        filename, fileStamp = self.filename, self.fileStamp
+        def load():
+            try:
+                f = datastream.MappedDataInputStream(file(filename, 'rb'))
+            except IOError:
+                raise FormatException('The MAP file \'' + filename + '\' was not found.')
+            with f:
+                stat = os.fstat(f.file.fileno())
+                if (stat.st_size, stat.st_mtime) != fileStamp:
+                    raise FormatException('The MAP file \'' + filename + '\' changed since it was opened, so its ' + name + ' can no longer be loaded.')
+                f.seek(offset)
+                return f.readCompressedArray(typecode, count)
+        return load
+        
+    def readZonesAndEntities(self, f):
         # Zone info!
         self.zone = []
-        for i in range(f.readInt()):
+        for i, record in enumerate(ZONE_RECORD.read(f, f.readInt())):
             zone = Zone()
             zone.id = i
-            zone.readFromMap(f)
+            zone.fromRecord(record)
             self.zone.append(zone)
 
         # Entities!
         self.entity = []
-        for i in range(f.readInt()):
+        for i, record in enumerate(ENTITY_RECORD.read(f, f.readInt())):
             ent = Entity()
             ent.id = i
-            ent.readFromMap(f)
+            ent.fromRecord(record)
             self.entity.append(ent)
-            
-        # We're done with the map file
-        f.close()
 
-    def saveMapFile(self, filename, vspFilename):
+    def saveMapFile(self, filename, vspFilename, level=datastream.DEFAULT_COMPRESSION_LEVEL, cache=None):
+        # With a datastream.SectionCache, layers that haven't changed since they were last saved aren't compressed again.
         try:
-            f = datastream.DataOutputStream(file(filename, 'wb'))
-        except IOError:
+            f = datastream.DataOutputStream(datastream.AtomicFile(filename), cache)
+        except EnvironmentError:
             raise FormatException('The MAP file \'' + filename + '\' could not be opened for writing.')
 
-        f.write(MAP_SIGNATURE)
-        f.writeInt(MAP_VERSION)
-        
-        # Write a dummy offset for now, but this needs to be backpatched, once the real map is completed.
-        vc = f.tell()
-        f.writeInt(0)
-        
-        # The usual crap.
-        f.writeFixedString(self.mapName, 256)
-        f.writeFixedString(vspFilename, 256)
-        f.writeFixedString(self.musicFilename, 256)
-        f.writeFixedString(','.join(self.renderOrder), 256)
-        f.writeFixedString(self.startEvent, 256)
-        f.writeUnsignedShort(self.startX)
-        f.writeUnsignedShort(self.startY)
-        f.writeInt(len(self.layer))
-        for lay in self.layer:
-            lay.writeToMap(f)
-        f.writeCompressed(struct.pack('<' + str(self.width * self.height) + 'b', *self.obsLayer))
-        f.writeCompressed(struct.pack('<' + str(self.width * self.height) + 'H', *self.zoneLayer))
-        f.writeInt(len(self.zone))
-        for z in self.zone:
-            z.writeToMap(f)
-        f.writeInt(len(self.entity))
-        for ent in self.entity:
-            ent.writeToMap(f)
-
-        # Write the vc offset.
-        end = f.tell()
-        f.seek(vc)
-        f.writeInt(end)
-        f.close()
+        with f:
+            f.write(MAP_SIGNATURE)
+            f.writeInt(MAP_VERSION)
+        
+            # Write a dummy offset for now, but this needs to be backpatched, once the real map is completed.
+            vc = f.tell()
+            f.writeInt(0)
+        
+            # The usual crap.
+            f.writeFixedString(self.mapName, 256)
+            f.writeFixedString(vspFilename, 256)
+            f.writeFixedString(self.musicFilename, 256)
+            f.writeFixedString(','.join(self.renderOrder), 256)
+            f.writeFixedString(self.startEvent, 256)
+            f.writeUnsignedShort(self.startX)
+            f.writeUnsignedShort(self.startY)
+            # Compress every layer and grid at once, and then write them out in order.
+            data = [datastream.fromArray(lay.data, TILE_TYPECODE) for lay in self.layer] + [datastream.fromArray(self.obsLayer, OBS_TYPECODE), datastream.fromArray(self.zoneLayer, ZONE_TYPECODE)]
+            compressed = datastream.compressAll(data, level, cache)
+            f.writeInt(len(self.layer))
+            for lay, layerData, compressedData in zip(self.layer, data, compressed):
+                lay.writeHeaderToMap(f)
+                f.writeCompressedSection(len(layerData), compressedData)
+            f.writeCompressedSection(len(data[-2]), compressed[-2])
+            f.writeCompressedSection(len(data[-1]), compressed[-1])
+            f.writeInt(len(self.zone))
+            ZONE_RECORD.write(f, [z.toRecord() for z in self.zone])
+            f.writeInt(len(self.entity))
+            ENTITY_RECORD.write(f, [ent.toRecord() for ent in self.entity])
+
+            # Write the vc offset.
+            end = f.tell()
+            f.seek(vc)
+            f.writeInt(end)
+        
+    def remapTiles(self, tileRemap, obsRemap):
+        # Renumber the tiles of every layer, and the obstructions, with remap tables like the ones VSP.dedup() gives.
+        # Tile 0 is only drawn on the first layer, and is empty on the rest, so on those it always stays 0.
+        keys = [key for key in self.renderOrder if key != 'E' and key != 'R']
+        firstLayer = keys and self.renderItem[keys[0]] or None
+        for layer in self.layer:
+            try:
+                layer.data = remapValues(layer.data, tileRemap, TILE_TYPECODE, layer is not firstLayer)
+            except FormatException as e:
+                raise FormatException('Layer #' + str(layer.id) + ' uses a tile that isn\'t in the VSP: ' + str(e))
+        try:
+            self.obsLayer = remapValues(self.obsLayer, obsRemap, OBS_TYPECODE)
+        except FormatException as e:
+            raise FormatException('The obstruction layer uses an obstruction tile that isn\'t in the VSP: ' + str(e))
         
     def convertFromTiled(self, filename):
         self.zoneDummyFilename = filename + '.zone.png'
+        # The document is read in a single pass, and each top-level element is converted (and then thrown away)
+        # as soon as it has been parsed, so memory stays bounded no matter how many <tile> elements there are.
         try:
-            tree = etree.parse(filename)
+            events = etree.iterparse(filename, events=('start', 'end'))
+            event, map = events.next()
         except:
             raise FormatException('Failure attempting to parse ' + filename + '.')
-        map = tree.getroot()
         if map.get('version') != '1.0':
-            raise FormatException('Unsupported version ' + map.get('version') + '. This only supports tiled 1.0 maps.')
+            raise FormatException('Unsupported version ' + str(map.get('version')) + '. This only supports tiled 1.0 maps.')
         if map.get('orientation') != 'orthogonal':
-            raise FormatException('Uses unsupported orientation \'' + map.get('orientation') + '\'. Only orthogonal maps are allowed.')
+            raise FormatException('Uses unsupported orientation \'' + str(map.get('orientation')) + '\'. Only orthogonal maps are allowed.')
         if map.get('tilewidth') != '16' or map.get('tileheight') != '16':
             raise FormatException('Unsupported map tile size ' + str(map.get('tilewidth')) + 'x' + str(map.get('tileheight')) + '. Only 16x16 is supported.') 
+        # Infinite maps store their layers as a set of <chunk>s.
+        importer = TiledImporter(filename, getIntegerNode(map, 'width'), getIntegerNode(map, 'height'), map.get('infinite') == '1')
         
-        props = getProperties(map)
-        print('    Importing properties...')
+        depth = 0
         try:
-            self.mapName = props.get('title', os.path.splitext(filename)[0])
-            self.musicFilename = props.get('music', '')
-            self.startEvent = props.get('start_event', '')
-            self.startX = getIntegerNode(props, 'start_x', 0)
-            self.startY = getIntegerNode(props, 'start_y', 0)
-        except FormatException as e:
-            raise FormatException('Bad map property: ' + str(e)) 
+            for event, elem in events:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                # Only direct children of <map> are handled here. Anything nested is dealt with along with its parent.
+                if depth:
+                    continue
+                if elem.tag == 'properties':
+                    importer.addProperties(readProperties(elem))
+                elif elem.tag == 'tileset':
+                    importer.addTileset(elem, [(tile.get('id'), tile) for tile in elem.iter('tile')])
+                elif elem.tag == 'objectgroup':
+                    importer.addObjectGroup(elem, elem.iter('object'))
+                elif elem.tag == 'layer':
+                    importer.addLayer(elem)
+                # Done with this part of the document.
+                elem.clear()
+        except SyntaxError:
+            raise FormatException('Failure attempting to parse ' + filename + '.')
+        importer.finish(self)
+        
+    def convertFromTiledJSON(self, filename):
+        self.zoneDummyFilename = filename + '.zone.png'
+        try:
+            f = file(filename, 'rb')
+            try:
+                map = json.load(f, object_hook=decodeJSONObject)
+            finally:
+                f.close()
+        except:
+            raise FormatException('Failure attempting to parse ' + filename + '.')
+        if type(map) != dict:
+            raise FormatException('Failure attempting to parse ' + filename + '. The document is not a Tiled JSON map.')
+        if map.get('orientation') != 'orthogonal':
+            raise FormatException('Uses unsupported orientation \'' + str(map.get('orientation')) + '\'. Only orthogonal maps are allowed.')
+        if str(map.get('tilewidth')) != '16' or str(map.get('tileheight')) != '16':
+            raise FormatException('Unsupported map tile size ' + str(map.get('tilewidth')) + 'x' + str(map.get('tileheight')) + '. Only 16x16 is supported.') 
+        importer = TiledImporter(filename, getIntegerNode(map, 'width'), getIntegerNode(map, 'height'))
         
-        print('    Importing tileset references...')
-        hasTiles = False
-        hasObs = False
-        obsGID = 0
-        hasZones = False
-        zoneGID = 0
-        zoneData = {}
-        for tileset in map.iter('tileset'):
-            if tileset.get('tilewidth') != '16' or tileset.get('tileheight') != '16':
-                raise FormatException('Unsupported tile size ' + str(map.get('tilewidth')) + 'x' + str(map.get('tileheight')) + ' on tileset ' + repr(tileset.get('name')) + '. Only 16x16 is supported.')
-
-            if tileset.get('name') == 'tiles':
-                if hasTiles:
-                    raise FormatException('This file has more than one \'tiles\' <tileset>.') 
-                hasTiles = True
-            elif tileset.get('name') == 'obstructions':
-                if hasObs:
-                    raise FormatException('This file has more than one \'obstructions\' <tileset>.') 
-                obsGID = getIntegerNode(tileset, 'firstgid')
-                hasObs = True
-            elif tileset.get('name') == 'zones':
-                if hasZones:
-                    raise FormatException('This file has more than one \'zones\' <tileset>.')
-                zoneGID = getIntegerNode(tileset, 'firstgid')
-                for tile in tileset.iter('tile'):
-                    if tile.get('id'):
-                        try:
-                            zone = Zone()
-                            zone.convertFromTiled(tile)
-                            zoneData[tile.get('id')] = zone
-                        except FormatException as e:
-                            raise FormatException('Invalid zone with id=' + repr(tile.get('id')) + ': ' + str(e))
-                    else:
-                        raise FormatException('There is a <tile> in the \'zones\' <tileset> without an id.')
-                hasZones = True
+        importer.addProperties(getProperties(map))
+        for tileset in map.get('tilesets') or []:
+            # Tile properties are either under 'tileproperties' (id: properties), or in newer versions, a list of 'tiles'.
+            if type(tileset.get('tiles')) == list:
+                tiles = [(tile.get('id'), tile) for tile in tileset.get('tiles')]
             else:
-                raise FormatException('Tileset ' + repr(tileset.get('name')) + ' that cannot be exported. Must be named \'tiles\', \'obstructions\' or \'zones\'') 
-        if not hasTiles:
-            raise FormatException('Missing a \'tiles\' tileset.')
-            
-        # Now convert a sparse map of id -> zone into a list of zones with a size of max id.
-        self.zone = [None] * max(int(id) + 1 for id, zone in zoneData.iteritems())
-        for id, zone in zoneData.iteritems():
-            self.zone[int(id)] = zone
-        # Fill any gaps with default zones:
-        for i in range(len(self.zone)):
-            self.zone[i] = self.zone[i] or Zone()
-            self.zone[i].id = i
-            
-        self.renderOrder = []
-        self.renderItem = {}
-
-        print('    Layers, retrace and entities...')
-        layerData = {}
-        # First pass, renderables.
-        for layer in map.iter():
-            if layer.tag == 'objectgroup':
-                if layer.get('name') == 'Entities':
-                    entData = {}
-                    self.renderOrder.append('E')
-                    for ob in layer.iter('object'):
-                        try:
-                            ent = Entity()
-                            ent.convertFromTiled(ob)
-                            entData[ent.id] = ent
-                        except FormatException as e:
-                            raise FormatException('Invalid entity with name=' + repr(ob.get('name')) + ': ' + str(e))                    
-
-                    self.entity = [None] * max(int(id) + 1 for id, ent in entData.iteritems())
-                    for id, ent in entData.iteritems():
-                        self.entity[int(id)] = ent
-                    # Error if there are any gaps in the list.
-                    for i in range(len(self.entity)):
-                        if not self.entity[i]:
-                            raise FormatException('Invalid map. All entities must have a id property, and these must be consecutive (no gaps). '
-                                                + 'Expected entity with id of ' + str(i) + '. '
-                                                + 'Maximum id was determined to be ' + str(len(self.entity) - 1) + ', so there should id from 0 up to and including '
-                                                + str(len(self.entity) - 1) + '.')
-                elif layer.get('name') == 'Retrace':
-                    self.renderOrder.append('R')
-                else:
-                    raise FormatException('Object layer ' + repr(tileset.get('name')) + ' cannot be exported. Must be named \'Retrace\' or \'Entities\'') 
-            if layer.tag == 'layer':        
-                if layer.get('name') != 'Obstructions' and layer.get('name') != 'Zones':
-                    lay = Layer()
-                    try:
-                        lay.convertFromTiled(layer)
-                    except FormatException as e:
-                        raise FormatException('Invalid layer with name=\'' + layer.get('name') + '\': ' + str(e))
-                    layerData[lay.id] = lay
-                    self.renderOrder.append(str(lay.id + 1))
-                    self.renderItem[lay.id + 1] = lay
-
-        # Now convert a sparse map of id -> zone into a list of layers with a size of max id.
-        self.layer = [None] * max(int(id) + 1 for id, lay in layerData.iteritems())
-        if not len(self.layer):
-            raise FormatException('Invalid map. Must contain at least one layer.')
-        for id, lay in layerData.iteritems():
-            self.layer[int(id)] = lay
-        # Error if there are any gaps in the list.
-        for i in range(len(self.layer)):
-            if not self.layer[i]:
-                raise FormatException('Invalid map. All layers must have a id property, and these must be consecutive (no gaps). '
-                    + 'Expected layer with id of ' + str(i) + '. '
-                    + 'Maximum id was determined to be ' + str(len(self.layer) - 1) + ', so there should id from 0 up to and including '
-                    + str(len(self.layer) - 1) + '.')
-
-        self.width = self.layer[0].width
-        self.height = self.layer[0].height
-
-        print('    Zones and obstructions...')
-        # Second pass: obstructions and zones.
-        for layer in map.iter('layer'):
-            if layer.get('name') == 'Obstructions':
-                if not hasObs:
-                    raise FormatException('This map has an \'Obstructions\' layer but is missing the \'obstructions\' tileset.')
-                data = layer.find('data')
-                if data != None:
-                    if data.get('encoding') or data.get('compression'):
-                        if data.get('encoding') == 'base64' and data.get('compression') == 'zlib':
-                            # Convert base64'd zlib'd chunk of 32-bit integers into a list of obs
-                            self.obsLayer = [t - obsGID for t in struct.unpack('<' + str(self.width * self.height) + 'i', zlib.decompress(base64.b64decode(str(data.text))))]
-                        else:
-                            raise FormatException('Cannot parse Obstructions layer with ' + str(data.get('encoding')) + ' encoding and ' + str(data.get('compression')) + ' compression.')
-                    else:
-                        # Convert <tile gid='N'/>... into a list of ints [obs, obs, obs...].
-                        self.obsLayer = [int(t.get('gid', str(obsGID))) - obsGID for t in data.iter('tile')]
-                else:
-                    raise FormatException('Obstructions layer is missing <data> tag.')
-            elif layer.get('name') == 'Zones':
-                if not hasZones:
-                    raise FormatException('This map has an \'Zones\' layer but is missing the \'zones\' tileset.')
-                data = layer.find('data')
-                if data != None:
-                    if data.get('encoding') or data.get('compression'):
-                        if data.get('encoding') == 'base64' and data.get('compression') == 'zlib':
-                            # Convert base64'd zlib'd chunk of 32-bit integers into a list of zones
-                            self.zoneLayer = [t - zoneGID for t in struct.unpack('<' + str(self.width * self.height) + 'i', zlib.decompress(base64.b64decode(str(data.text))))]
-                        else:
-                            raise FormatException('Cannot parse Zones layer with ' + str(data.get('encoding')) + ' encoding and ' + str(data.get('compression')) + ' compression.')
-                    else:
-                        # Convert <tile gid='N'/>... into a list of ints [zone, zone, zone...].
-                        self.zoneLayer = [int(t.get('gid', str(zoneGID))) - zoneGID for t in data.iter('tile')]
-                else:
-                    raise FormatException('Zones layer is missing <data> tag.')
-        print('    ...OK.')
+                tiles = [(id, {'properties': props}) for id, props in (tileset.get('tileproperties') or {}).iteritems()]
+            importer.addTileset(tileset, tiles)
+        for layer in map.get('layers') or []:
+            if layer.get('type') == 'objectgroup':
+                importer.addObjectGroup(layer, layer.get('objects') or [])
+            elif layer.get('type') == 'tilelayer':
+                importer.addLayer(layer)
+            else:
+                raise FormatException('Layer ' + repr(layer.get('name')) + ' has unsupported type ' + repr(layer.get('type')) + '.')
+        importer.finish(self)
+        
+    def toTiledProperties(self):
+        return [
+            ('title', self.mapName),
+            ('music', self.musicFilename),
+            ('start_event', self.startEvent),
+            ('start_x', str(self.startX)),
+            ('start_y', str(self.startY)),
+        ]
+        
+    def encodeTiledLayers(self, encoding, chunkSize=0, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+        # The data of every tile layer in a Tiled export (see encodeGrids), in the order they get written:
+        # the visible layers in render order, and then Obstructions and Zones.
+        grids = []
+        for key in self.renderOrder:
+            if key != 'E' and key != 'R':
+                layer = self.renderItem[key]
+                # tile 0 is drawn as-is on the first layer, but is completely transparent on higher layers.
+                grids.append((toGIDs(layer.data, 1, len(grids) > 0), layer.width, layer.height))
+        grids.append((toGIDs(self.obsLayer, self.vsp.tileLastGID + 1), self.width, self.height))
+        grids.append((toGIDs(self.zoneLayer, self.vsp.obsLastGID + 1), self.width, self.height))
+        return encodeGrids(grids, encoding, chunkSize, level)
         
-    def toTiledDocument(self, compress=False):
-        doc = xml.dom.minidom.Document()
+    def writeTiledDocument(self, f, encoding=TMX_ENCODING_XML, chunkSize=0, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+        # With a chunkSize, this writes an infinite map, where each layer is split into chunkSize x chunkSize <chunk>s,
+        # and any chunks which are entirely empty are left out.
+        doc = xmlstream.XMLOutputStream(f)
         
-        def addProperty(doc, props, key, value):
-            prop = doc.createElement('property')
-            prop.setAttribute('name', key)
-            prop.setAttribute('value', value)
-            props.appendChild(prop)
+        def writeProperties(doc, props):
+            doc.start('properties')
+            for key, value in props:
+                doc.element('property', {'name': key, 'value': value})
+            doc.end()
         
         # Map data
-        map = doc.createElement('map')
-        map.setAttribute('version', '1.0')
-        map.setAttribute('orientation', 'orthogonal')
-        map.setAttribute('width', str(self.width))
-        map.setAttribute('height', str(self.height))
-        map.setAttribute('tilewidth', str(VSP_TILESIZE))
-        map.setAttribute('tileheight', str(VSP_TILESIZE))
+        attrs = {
+            'version': '1.0',
+            'orientation': 'orthogonal',
+            'width': str(self.width),
+            'height': str(self.height),
+            'tilewidth': str(VSP_TILESIZE),
+            'tileheight': str(VSP_TILESIZE),
+        }
+        if chunkSize:
+            attrs['infinite'] = '1'
+        doc.start('map', attrs)
         
         print('    Exporting properties...')
-        props = doc.createElement('properties')
-        addProperty(doc, props, 'title', self.mapName)
-        addProperty(doc, props, 'music', self.musicFilename)
-        addProperty(doc, props, 'start_event', self.startEvent)
-        addProperty(doc, props, 'start_x', str(self.startX))
-        addProperty(doc, props, 'start_y', str(self.startY))
-        
-        map.appendChild(props)
+        writeProperties(doc, self.toTiledProperties())
         
         # Tiles
         print('    Adding tileset reference...')
-        tileset = doc.createElement('tileset')
-        tileset.setAttribute('firstgid', '1')
-        tileset.setAttribute('name', 'tiles')
-        tileset.setAttribute('tilewidth', str(VSP_TILESIZE))
-        tileset.setAttribute('tileheight', str(VSP_TILESIZE))
-        
-        image = doc.createElement('image')
-        image.setAttribute('source', self.vspFilename + self.vsp.tileImageName)
-        tileset.appendChild(image)
-        map.appendChild(tileset)
+        doc.start('tileset', {'firstgid': '1', 'name': 'tiles', 'tilewidth': str(VSP_TILESIZE), 'tileheight': str(VSP_TILESIZE)})
+        doc.element('image', {'source': self.vspFilename + self.vsp.tileImageName})
+        doc.end()
         
         # Obstructions
         print('    Adding obstruction tileset reference...')
-        tileset = doc.createElement('tileset')
-        tileset.setAttribute('firstgid', str(self.vsp.tileLastGID + 1))
-        tileset.setAttribute('name', 'obstructions')
-        tileset.setAttribute('tilewidth', str(VSP_TILESIZE))
-        tileset.setAttribute('tileheight', str(VSP_TILESIZE))
-        
-        image = doc.createElement('image')
-        image.setAttribute('source', self.vspFilename + self.vsp.obsImageName)
-        tileset.appendChild(image)
-        map.appendChild(tileset)
+        doc.start('tileset', {'firstgid': str(self.vsp.tileLastGID + 1), 'name': 'obstructions', 'tilewidth': str(VSP_TILESIZE), 'tileheight': str(VSP_TILESIZE)})
+        doc.element('image', {'source': self.vspFilename + self.vsp.obsImageName})
+        doc.end()
         
         # Zone
         print('    Zone bank...')
-        tileset = doc.createElement('tileset')
-        tileset.setAttribute('firstgid', str(self.vsp.obsLastGID + 1))
-        tileset.setAttribute('name', 'zones')
-        tileset.setAttribute('tilewidth', str(VSP_TILESIZE))
-        tileset.setAttribute('tileheight', str(VSP_TILESIZE))
+        doc.start('tileset', {'firstgid': str(self.vsp.obsLastGID + 1), 'name': 'zones', 'tilewidth': str(VSP_TILESIZE), 'tileheight': str(VSP_TILESIZE)})
+        doc.element('image', {'source': os.path.basename(self.zoneDummyFilename)})
+        for i in range(1, len(self.zone)):
+            doc.start('tile', {'id': str(i)})
+            writeProperties(doc, self.zone[i].toTiledProperties())
+            doc.end()
+        doc.end()
         
-        image = doc.createElement('image')
-        image.setAttribute('source', os.path.basename(self.zoneDummyFilename))
-        tileset.appendChild(image)
+        def writeEncoded(doc, tag, attrs, data, width):
+            if encoding in TMX_COMPRESSED_ENCODINGS:
+                doc.textElement(tag, attrs, data)
+            elif encoding == TMX_ENCODING_CSV:
+                doc.textElement(tag, attrs, encodeCSVGIDs(data, width))
+            else:
+                doc.start(tag, attrs)
+                doc.repeatedElements('tile', 'gid', data)
+                doc.end()
+                
+        def writeData(doc, width):
+            if encoding in TMX_COMPRESSED_ENCODINGS:
+                attrs = {'encoding': 'base64', 'compression': encoding}
+            elif encoding == TMX_ENCODING_CSV:
+                attrs = {'encoding': 'csv'}
+            else:
+                attrs = {}
+            data = next(layerData)
+            if not chunkSize:
+                writeEncoded(doc, 'data', attrs, data, width)
+                return
+            doc.start('data', attrs)
+            for x, y, chunk in data:
+                writeEncoded(doc, 'chunk', {'x': str(x), 'y': str(y), 'width': str(chunkSize), 'height': str(chunkSize)}, chunk, chunkSize)
+            doc.end()
         
-        for i in range(1, len(self.zone)):
-            tile = doc.createElement('tile')
-            tile.setAttribute('id', str(i))
-            props = doc.createElement('properties')
-            z = self.zone[i]
-            addProperty(doc, props, 'name', z.name)
-            addProperty(doc, props, 'allow_adjacent', str(z.method and 'true' or 'false'))
-            addProperty(doc, props, 'activation_event', str(z.activationEvent))
-            addProperty(doc, props, 'activation_chance', str(z.chance))
-            addProperty(doc, props, 'activation_delay', str(z.delay))
-            tile.appendChild(props)
-            tileset.appendChild(tile)
-        map.appendChild(tileset)
+        # Every layer's data is prepared up front, so it can all be compressed at once.
+        layerData = iter(self.encodeTiledLayers(encoding, chunkSize, level))
         
         # Tile layers (iterated in order by the map's rstring data)
-        first = True
         print('    Visible layers...')
         for key in self.renderOrder:
             if key == 'E':
                 print('        Entities...')
-                lay = doc.createElement('objectgroup')
-                lay.setAttribute('width', str(self.width))
-                lay.setAttribute('height', str(self.height))
-                lay.setAttribute('name', 'Entities')
-                lay.setAttribute('color', '#99ff00')
+                doc.start('objectgroup', {'width': str(self.width), 'height': str(self.height), 'name': 'Entities', 'color': '#99ff00'})
                 for entity in self.entity:
-                    obj = doc.createElement('object')
-                    obj.setAttribute('name', str(entity.description))
-                    obj.setAttribute('type', 'entity')
-                    obj.setAttribute('x', str(entity.x * VSP_TILESIZE))
-                    obj.setAttribute('y', str(entity.y * VSP_TILESIZE))
-                    obj.setAttribute('width', str(VSP_TILESIZE))
-                    obj.setAttribute('height', str(VSP_TILESIZE))
-                    
-                    props = doc.createElement('properties')
-                    addProperty(doc, props, 'id', str(entity.id))
-                    addProperty(doc, props, 'filename', str(entity.filename))
-                    addProperty(doc, props, 'direction', str(entity.direction))
-                    addProperty(doc, props, 'is_obstructable', str(entity.isObstruction and 'true' or 'false'))
-                    addProperty(doc, props, 'is_obstruction', str(entity.isObstruction and 'true' or 'false'))
-                    addProperty(doc, props, 'autoface', str(entity.autoface and 'true' or 'false'))
-                    addProperty(doc, props, 'speed', str(entity.speed))
-                    addProperty(doc, props, 'movement_mode', str(entity.movementMode))
-                    if entity.movementMode == 'wander_rect':
-                        addProperty(doc, props, 'wander_x1', str(entity.wanderX1))
-                        addProperty(doc, props, 'wander_y1', str(entity.wanderY1))
-                        addProperty(doc, props, 'wander_x2', str(entity.wanderX2))
-                        addProperty(doc, props, 'wander_y2', str(entity.wanderY2))
-                        addProperty(doc, props, 'wander_delay', str(entity.wanderDelay))
-                    elif entity.movementMode == 'wander_zone':
-                        addProperty(doc, props, 'wander_delay', str(entity.wanderDelay))
-                    elif entity.movementMode == 'script':
-                        addProperty(doc, props, 'movescript', str(entity.movescript))
-                    addProperty(doc, props, 'activation_event', str(entity.activationEvent))
-                    obj.appendChild(props)
-                    
-                    lay.appendChild(obj)
-                map.appendChild(lay)
+                    doc.start('object', {
+                        'name': str(entity.description),
+                        'type': 'entity',
+                        'x': str(entity.x * VSP_TILESIZE),
+                        'y': str(entity.y * VSP_TILESIZE),
+                        'width': str(VSP_TILESIZE),
+                        'height': str(VSP_TILESIZE),
+                    })
+                    writeProperties(doc, entity.toTiledProperties())
+                    doc.end()
+                doc.end()
             elif key == 'R':
                 # This object layer needs to exist solely to give a render position to HookRetrace.
                 print('        Retrace...')
-                lay = doc.createElement('objectgroup')
-                lay.setAttribute('width', str(self.width))
-                lay.setAttribute('height', str(self.height))
-                lay.setAttribute('name', 'Retrace')
-                map.appendChild(lay)
+                doc.element('objectgroup', {'width': str(self.width), 'height': str(self.height), 'name': 'Retrace'})
             else:
                 layer = self.renderItem[key]
                 print('        Layer #' + str(layer.id) + ': ' + layer.name + '...')
-                lay = doc.createElement('layer')
-                lay.setAttribute('name', layer.name)
-                lay.setAttribute('width', str(layer.width))
-                lay.setAttribute('height', str(layer.height))
-                lay.setAttribute('opacity', str(layer.alpha))
-                
-                props = doc.createElement('properties')
-                addProperty(doc, props, 'id', str(layer.id))
-                addProperty(doc, props, 'parallax_x', str(layer.parallaxX))
-                addProperty(doc, props, 'parallax_y', str(layer.parallaxY))
-                lay.appendChild(props)
-                
-                data = doc.createElement('data')
-                # tile 0 is drawn as-is on the first layer, but is completely transparent on higher layers.
-                if first:
-                    if compress:
-                        data.setAttribute('encoding', 'base64')
-                        data.setAttribute('compression', 'zlib')                        
-                        text = doc.createTextNode(base64.b64encode(zlib.compress(struct.pack('<' + str(layer.width * layer.height) + 'i', *[t + 1 for t in layer.data]))))
-                        data.appendChild(text)
-                    else:
-                        for t in layer.data:
-                            tile = doc.createElement('tile')
-                            tile.setAttribute('gid', str(t + 1))
-                            data.appendChild(tile)
-                    first = False
-                else:
-                    if compress:
-                        data.setAttribute('encoding', 'base64')
-                        data.setAttribute('compression', 'zlib')
-                        text = doc.createTextNode(base64.b64encode(zlib.compress(struct.pack('<' + str(layer.width * layer.height) + 'i', *[t != 0 and t + 1 or 0 for t in layer.data]))))
-                        data.appendChild(text)
-                    else:
-                        for t in layer.data:
-                            tile = doc.createElement('tile')
-                            tile.setAttribute('gid', t != 0 and str(t + 1) or '0')
-                            data.appendChild(tile)
-                lay.appendChild(data)
-                map.appendChild(lay)
+                doc.start('layer', {'name': layer.name, 'width': str(layer.width), 'height': str(layer.height), 'opacity': str(layer.alpha)})
+                writeProperties(doc, layer.toTiledProperties())
+                writeData(doc, layer.width)
+                doc.end()
         
         # Obstructions
         print('    Obstruction layer...')
-        lay = doc.createElement('layer')
-        lay.setAttribute('name', 'Obstructions')
-        lay.setAttribute('width', str(self.width))
-        lay.setAttribute('height', str(self.height))
-        lay.setAttribute('opacity', '1')
-        
-        data = doc.createElement('data')
-        id = self.vsp.tileLastGID + 1
-        if compress:
-            data.setAttribute('encoding', 'base64')
-            data.setAttribute('compression', 'zlib')
-            text = doc.createTextNode(base64.b64encode(zlib.compress(struct.pack('<' + str(self.width * self.height) + 'i', *[t + id for t in self.obsLayer]))))
-            data.appendChild(text)
-        else:
-            for t in self.obsLayer:
-                tile = doc.createElement('tile')
-                tile.setAttribute('gid', str(t + id))
-                data.appendChild(tile)
-        lay.appendChild(data)
-        map.appendChild(lay)
+        doc.start('layer', {'name': 'Obstructions', 'width': str(self.width), 'height': str(self.height), 'opacity': '1'})
+        writeData(doc, self.width)
+        doc.end()
         
         # Zones
         print('    Zone layer...')
-        lay = doc.createElement('layer')
-        lay.setAttribute('name', 'Zones')
-        lay.setAttribute('width', str(self.width))
-        lay.setAttribute('height', str(self.height))
-        lay.setAttribute('opacity', str(1))
-        
-        data = doc.createElement('data')
-        id = self.vsp.obsLastGID + 1
-        if compress:
-            data.setAttribute('encoding', 'base64')
-            data.setAttribute('compression', 'zlib')
-            text = doc.createTextNode(base64.b64encode(zlib.compress(struct.pack('<' + str(self.width * self.height) + 'i', *[t + id for t in self.zoneLayer]))))
-            data.appendChild(text)
-        else:
-            for t in self.zoneLayer:
-                tile = doc.createElement('tile')
-                tile.setAttribute('gid', str(t + id))
-                data.appendChild(tile)
-        lay.appendChild(data)
-        map.appendChild(lay)
+        doc.start('layer', {'name': 'Zones', 'width': str(self.width), 'height': str(self.height), 'opacity': str(1)})
+        writeData(doc, self.width)
+        doc.end()
         
         # Done!
-        doc.appendChild(map)
-        return doc
\ No newline at end of file
+        doc.close()
+        
+    def writeTiledJSON(self, f, encoding=TMX_ENCODING_ZLIB, chunkSize=0, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+        # The same document as writeTiledDocument, in Tiled's JSON map format.
+        # Layer data is base64'd zlib'd (or gzip'd) 32-bit integers, or for any other encoding, a plain array of numbers.
+        def encodeData(data):
+            if encoding in TMX_COMPRESSED_ENCODINGS:
+                return data
+            return data.tolist()
+            
+        def tileset(firstGID, name, image, rows):
+            return {
+                'firstgid': firstGID,
+                'name': name,
+                'image': image,
+                'imagewidth': 20 * VSP_TILESIZE,
+                'imageheight': rows * VSP_TILESIZE,
+                'tilewidth': VSP_TILESIZE,
+                'tileheight': VSP_TILESIZE,
+                'margin': 0,
+                'spacing': 0,
+                'properties': {},
+            }
+            
+        def tileLayer(name, width, height, opacity, props):
+            layer = {
+                'type': 'tilelayer',
+                'name': name,
+                'x': 0,
+                'y': 0,
+                'width': width,
+                'height': height,
+                'opacity': opacity,
+                'visible': True,
+                'properties': dict(props),
+            }
+            if encoding in TMX_COMPRESSED_ENCODINGS:
+                layer['encoding'] = 'base64'
+                layer['compression'] = encoding
+            data = next(layerData)
+            if chunkSize:
+                layer['chunks'] = [{'x': x, 'y': y, 'width': chunkSize, 'height': chunkSize, 'data': encodeData(chunk)} for x, y, chunk in data]
+            else:
+                layer['data'] = encodeData(data)
+            return layer
+            
+        def objectGroup(name, objects, color=None):
+            layer = {
+                'type': 'objectgroup',
+                'name': name,
+                'x': 0,
+                'y': 0,
+                'width': self.width,
+                'height': self.height,
+                'opacity': 1,
+                'visible': True,
+                'objects': objects,
+            }
+            if color:
+                layer['color'] = color
+            return layer
+        
+        print('    Exporting properties and tileset references...')
+        zones = tileset(self.vsp.obsLastGID + 1, 'zones', os.path.basename(self.zoneDummyFilename), (len(self.zone) + 19) // 20)
+        zones['tileproperties'] = dict((str(i), dict(self.zone[i].toTiledProperties())) for i in range(1, len(self.zone)))
+        header = json.dumps({
+            'version': 1,
+            'infinite': bool(chunkSize),
+            'orientation': 'orthogonal',
+            'width': self.width,
+            'height': self.height,
+            'tilewidth': VSP_TILESIZE,
+            'tileheight': VSP_TILESIZE,
+            'properties': dict(self.toTiledProperties()),
+            'tilesets': [
+                tileset(1, 'tiles', self.vspFilename + self.vsp.tileImageName, getTileSheetRows(self.vsp.tileCount)),
+                tileset(self.vsp.tileLastGID + 1, 'obstructions', self.vspFilename + self.vsp.obsImageName, getTileSheetRows(self.vsp.obsCount)),
+                zones,
+            ],
+        }, sort_keys=True)
+        # The layers go last. Their data is all prepared up front, so it can all be compressed at once.
+        layerData = iter(self.encodeTiledLayers(encoding, chunkSize, level))
+        f.write(header[:-1] + ', "layers": [\n')
+        
+        layers = []
+        def writeLayer(layer):
+            if layers:
+                f.write(',\n')
+            f.write(json.dumps(layer, sort_keys=True))
+            layers.append(layer['name'])
+        
+        print('    Visible layers...')
+        for key in self.renderOrder:
+            if key == 'E':
+                print('        Entities...')
+                writeLayer(objectGroup('Entities', [{
+                    'name': str(entity.description),
+                    'type': 'entity',
+                    'x': entity.x * VSP_TILESIZE,
+                    'y': entity.y * VSP_TILESIZE,
+                    'width': VSP_TILESIZE,
+                    'height': VSP_TILESIZE,
+                    'rotation': 0,
+                    'visible': True,
+                    'properties': dict(entity.toTiledProperties()),
+                } for entity in self.entity], '#99ff00'))
+            elif key == 'R':
+                # This object layer needs to exist solely to give a render position to HookRetrace.
+                print('        Retrace...')
+                writeLayer(objectGroup('Retrace', []))
+            else:
+                layer = self.renderItem[key]
+                print('        Layer #' + str(layer.id) + ': ' + layer.name + '...')
+                writeLayer(tileLayer(layer.name, layer.width, layer.height, layer.alpha, layer.toTiledProperties()))
+        
+        print('    Obstruction layer...')
+        writeLayer(tileLayer('Obstructions', self.width, self.height, 1, []))
+        print('    Zone layer...')
+        writeLayer(tileLayer('Zones', self.width, self.height, 1, []))
+        f.write('\n]}\n')
+        
+def openMapDocument(filename):
+    # Load a .map (lazily), .tmx or Tiled JSON map, to be changed and written back with saveMapDocument().
+    map = Map()
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.map':
+        map.scanMapFile(filename)
+        return map
+    if extension == '.json':
+        map.convertFromTiledJSON(filename)
+    else:
+        map.convertFromTiled(filename)
+    if getattr(map, 'vspFilename', None) is None:
+        raise FormatException('\'' + filename + '\' has no \'tiles\' tileset image to tell which VSP it uses.')
+    map.filename = filename
+    return map
+    
+def saveMapDocument(map, filename, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+    # Write a map from openMapDocument() back out in the same format. A Tiled document keeps the encoding it had,
+    # and gets its tilesets from map.vsp, which has to be set.
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.map':
+        map.saveMapFile(filename, map.vspFilename, level)
+        return
+    f = datastream.AtomicFile(filename)
+    try:
+        if extension == '.json':
+            map.writeTiledJSON(f, map.tiledEncoding, map.tiledChunkSize, level)
+        else:
+            map.writeTiledDocument(f, map.tiledEncoding, map.tiledChunkSize, level)
+    except:
+        f.discard()
+        raise
+    f.close()
+    
+def remapMapFile(filename, vsp, tileRemap, obsRemap, level=datastream.DEFAULT_COMPRESSION_LEVEL):
+    # Renumber the tiles and obstructions of a .map, .tmx or Tiled JSON map in place, after the tiles of its VSP
+    # were rearranged (with remap tables like the ones VSP.dedup() gives). vsp is the rearranged VSP.
+    map = openMapDocument(filename)
+    map.vsp = vsp
+    map.remapTiles(tileRemap, obsRemap)
+    saveMapDocument(map, filename, level)
+    
+class TiledImporter(object):
+    # Collects the parts of a Tiled map as they're read (from either a .tmx or a Tiled JSON document),
+    # checks they fit the restrictions of the .map format, and assembles them into a Map at the end.
+    def __init__(self, filename, width, height, chunked=False):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.chunked = chunked
+        self.props = {}
+        self.hasTiles = False
+        self.hasObs = False
+        self.obsGID = 0
+        self.hasZones = False
+        self.zoneGID = 0
+        self.zoneData = {}
+        self.entData = {}
+        self.layerData = {}
+        self.obsLayer = None
+        self.zoneLayer = None
+        self.renderOrder = []
+        self.renderItem = {}
+        # The image each tileset uses, by name, and how the layers are encoded, so the document can be written back.
+        self.images = {}
+        self.layout = None
+        
+    def addProperties(self, props):
+        print('    Importing properties...')
+        self.props = props
+        
+    def addTileset(self, tileset, tiles):
+        # tiles is a list of (id, node) for any tiles in the tileset that have properties.
+        print('    Importing tileset reference ' + repr(tileset.get('name')) + '...')
+        if str(tileset.get('tilewidth')) != '16' or str(tileset.get('tileheight')) != '16':
+            raise FormatException('Unsupported tile size ' + str(tileset.get('tilewidth')) + 'x' + str(tileset.get('tileheight')) + ' on tileset ' + repr(tileset.get('name')) + '. Only 16x16 is supported.')
+
+        if type(tileset) == dict:
+            self.images[tileset.get('name')] = tileset.get('image')
+        elif tileset.find('image') is not None:
+            self.images[tileset.get('name')] = tileset.find('image').get('source')
+
+        if tileset.get('name') == 'tiles':
+            if self.hasTiles:
+                raise FormatException('This file has more than one \'tiles\' tileset.') 
+            self.hasTiles = True
+        elif tileset.get('name') == 'obstructions':
+            if self.hasObs:
+                raise FormatException('This file has more than one \'obstructions\' tileset.') 
+            self.obsGID = getIntegerNode(tileset, 'firstgid')
+            self.hasObs = True
+        elif tileset.get('name') == 'zones':
+            if self.hasZones:
+                raise FormatException('This file has more than one \'zones\' tileset.')
+            self.zoneGID = getIntegerNode(tileset, 'firstgid')
+            for id, tile in tiles:
+                if id is not None and id != '':
+                    try:
+                        zone = Zone()
+                        zone.convertFromTiled(tile)
+                        self.zoneData[str(id)] = zone
+                    except FormatException as e:
+                        raise FormatException('Invalid zone with id=' + repr(str(id)) + ': ' + str(e))
+                else:
+                    raise FormatException('There is a tile in the \'zones\' tileset without an id.')
+            self.hasZones = True
+        else:
+            raise FormatException('Tileset ' + repr(tileset.get('name')) + ' that cannot be exported. Must be named \'tiles\', \'obstructions\' or \'zones\'') 
+            
+    def addObjectGroup(self, layer, objects):
+        if layer.get('name') == 'Entities':
+            print('    Entities...')
+            self.renderOrder.append('E')
+            for ob in objects:
+                try:
+                    ent = Entity()
+                    ent.convertFromTiled(ob)
+                    self.entData[ent.id] = ent
+                except FormatException as e:
+                    raise FormatException('Invalid entity with name=' + repr(ob.get('name')) + ': ' + str(e))                    
+        elif layer.get('name') == 'Retrace':
+            print('    Retrace...')
+            self.renderOrder.append('R')
+        else:
+            raise FormatException('Object layer ' + repr(layer.get('name')) + ' cannot be exported. Must be named \'Retrace\' or \'Entities\'') 
+            
+    def addLayer(self, layer):
+        if self.layout is None:
+            self.layout = getTiledLayout(layer, self.chunked)
+        if layer.get('name') == 'Obstructions':
+            print('    Obstructions...')
+            if not self.hasObs:
+                raise FormatException('This map has an \'Obstructions\' layer but it is not preceded by the \'obstructions\' tileset.')
+            # Convert the GIDs into a list of ints [obs, obs, obs...].
+            try:
+                self.obsLayer = fromGIDs(readLayerData(layer, self.width, self.height, self.chunked), self.obsGID, OBS_TYPECODE)
+            except FormatException as e:
+                raise FormatException('Invalid Obstructions layer: ' + str(e))
+        elif layer.get('name') == 'Zones':
+            print('    Zones...')
+            if not self.hasZones:
+                raise FormatException('This map has an \'Zones\' layer but it is not preceded by the \'zones\' tileset.')
+            # Convert the GIDs into a list of ints [zone, zone, zone...].
+            try:
+                self.zoneLayer = fromGIDs(readLayerData(layer, self.width, self.height, self.chunked), self.zoneGID, ZONE_TYPECODE)
+            except FormatException as e:
+                raise FormatException('Invalid Zones layer: ' + str(e))
+        else:
+            print('    Layer ' + repr(layer.get('name')) + '...')
+            lay = Layer()
+            try:
+                lay.convertFromTiled(layer, self.chunked)
+            except FormatException as e:
+                raise FormatException('Invalid layer with name=\'' + str(layer.get('name')) + '\': ' + str(e))
+            self.layerData[lay.id] = lay
+            self.renderOrder.append(str(lay.id + 1))
+            self.renderItem[str(lay.id + 1)] = lay
+            
+    def finish(self, map):
+        if not self.hasTiles:
+            raise FormatException('Missing a \'tiles\' tileset.')
+        
+        props = self.props
+        try:
+            map.mapName = props.get('title', os.path.splitext(self.filename)[0])
+            map.musicFilename = props.get('music', '')
+            map.startEvent = props.get('start_event', '')
+            map.startX = getIntegerNode(props, 'start_x', 0)
+            map.startY = getIntegerNode(props, 'start_y', 0)
+        except FormatException as e:
+            raise FormatException('Bad map property: ' + str(e)) 
+            
+        # Now convert a sparse map of id -> zone into a list of zones with a size of max id.
+        map.zone = [None] * max([int(id) + 1 for id, zone in self.zoneData.iteritems()] or [1])
+        for id, zone in self.zoneData.iteritems():
+            map.zone[int(id)] = zone
+        # Fill any gaps with default zones:
+        for i in range(len(map.zone)):
+            map.zone[i] = map.zone[i] or Zone()
+            map.zone[i].id = i
+            
+        map.entity = [None] * max([int(id) + 1 for id, ent in self.entData.iteritems()] or [0])
+        for id, ent in self.entData.iteritems():
+            map.entity[int(id)] = ent
+        # Error if there are any gaps in the list.
+        for i in range(len(map.entity)):
+            if not map.entity[i]:
+                raise FormatException('Invalid map. All entities must have a id property, and these must be consecutive (no gaps). '
+                                    + 'Expected entity with id of ' + str(i) + '. '
+                                    + 'Maximum id was determined to be ' + str(len(map.entity) - 1) + ', so there should id from 0 up to and including '
+                                    + str(len(map.entity) - 1) + '.')
+
+        # Now convert a sparse map of id -> layer into a list of layers with a size of max id.
+        map.layer = [None] * max([int(id) + 1 for id, lay in self.layerData.iteritems()] or [0])
+        if not len(map.layer):
+            raise FormatException('Invalid map. Must contain at least one layer.')
+        for id, lay in self.layerData.iteritems():
+            map.layer[int(id)] = lay
+        # Error if there are any gaps in the list.
+        for i in range(len(map.layer)):
+            if not map.layer[i]:
+                raise FormatException('Invalid map. All layers must have a id property, and these must be consecutive (no gaps). '
+                    + 'Expected layer with id of ' + str(i) + '. '
+                    + 'Maximum id was determined to be ' + str(len(map.layer) - 1) + ', so there should id from 0 up to and including '
+                    + str(len(map.layer) - 1) + '.')
+
+        map.renderOrder = self.renderOrder
+        map.renderItem = self.renderItem
+        map.tiledEncoding, map.tiledChunkSize = self.layout or (TMX_ENCODING_XML, 0)
+        # The tileset images are named after the VSP (and zone dummy image) the map was exported with.
+        tileImage = self.images.get('tiles')
+        if tileImage and tileImage.endswith(VSP_TILE_IMAGE_NAME):
+            map.vspFilename = tileImage[:-len(VSP_TILE_IMAGE_NAME)]
+        if self.images.get('zones'):
+            map.zoneDummyFilename = os.path.join(os.path.dirname(self.filename), self.images.get('zones'))
+        map.width = map.layer[0].width
+        map.height = map.layer[0].height
+        
+        # Maps without an Obstructions or Zones layer get empty ones.
+        map.obsLayer = self.obsLayer
+        map.zoneLayer = self.zoneLayer
+        if map.obsLayer is None:
+            map.obsLayer = array.array(OBS_TYPECODE, [0]) * (map.width * map.height)
+        if map.zoneLayer is None:
+            map.zoneLayer = array.array(ZONE_TYPECODE, [0]) * (map.width * map.height)
+        if len(map.obsLayer) != map.width * map.height or len(map.zoneLayer) != map.width * map.height:
+            raise FormatException('The Obstructions and Zones layers must both contain exactly ' + str(map.width * map.height) + ' tiles, to match a map that is ' + str(map.width) + 'x' + str(map.height) + ' in size.')
+        print('    ...OK.')
@@ -1,40 +1,54 @@
 #!/usr/bin/env python
 import os
+import sys
+import traceback
+import StringIO
+import multiprocessing
+import datastream
 import v3formats
+import manifest
 
-def convertMap(name, needVSP, compress):
+# How long convertFiles waits on a single job before checking again. Waiting with a timeout keeps Ctrl+C working.
+JOB_POLL_TIMEOUT = 60
+
+def convertMap(name, needVSP, encoding, extension='.tmx', chunkSize=0, level=datastream.DEFAULT_COMPRESSION_LEVEL):
     map = v3formats.Map()
     print('Loading \'' + name + '\'...')
     try:
         map.loadMapFile(name)
     except v3formats.FormatException as e:
         sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
-        return
+        return False
     if needVSP:
         convertVSP(vsp = map.vsp)
     print('Creating zone dummy image...')
     map.dumpZoneDummyImage()
     print('Converting map...')
-    f = file(os.path.splitext(name)[0] + '.tmx', 'w')
-    doc = map.toTiledDocument(compress)
-    print('    Saving document...')
-    f.write(doc.toprettyxml(indent='    '))
+    filename = os.path.splitext(name)[0] + extension
+    f = file(filename, 'w')
+    if extension == '.json':
+        map.writeTiledJSON(f, encoding, chunkSize, level)
+    else:
+        map.writeTiledDocument(f, encoding, chunkSize, level)
     f.close()
-    print('    Saved to \'' + os.path.splitext(name)[0] + '.tmx\'.')
+    print('    Saved to \'' + filename + '\'.')
     print('Done.')
+    return True
     
 def convertVSP(name='', **kwargs):
     vsp = None
-    if 'vsp' in kwargs:
-        vsp = kwargs['vsp']
-    else:
-        vsp = v3formats.VSP()
-        print('Loading \'' + name + '\'...')
-        try:
-            vsp.loadVSPFile(name)
-        except v3formats.FormatException as e:
-            sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
-            return
+    try:
+        if 'vsp' in kwargs:
+            vsp = kwargs['vsp']
+        else:
+            print('Loading \'' + name + '\'...')
+            vsp = v3formats.VSP_REGISTRY.load(name)
+        if not v3formats.VSP_REGISTRY.claimDump(vsp.filename):
+            print('Tileset \'' + vsp.filename + '\' was already converted.')
+            return True
+    except v3formats.FormatException as e:
+        sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+        return False
     print('Converting tileset...')
     vsp.dumpTiles()
     print('Converting tileset obstructions...')
@@ -42,35 +56,263 @@ def convertVSP(name='', **kwargs):
     print('Exporting animation info...')
     vsp.toAnimDocument().write(vsp.filename + '.anim', encoding = 'UTF-8', xml_declaration = True)
     print('    Saved to \'' + vsp.filename + '.anim\'.')    
+    return True
 
-if __name__ == '__main__':
-    import sys
+def printMapInfo(name):
+    # Describe a map without converting it. Only the header, zones and entities get decoded, not the layers or VSP.
+    try:
+        map = v3formats.Map.open(name, lazy=True)
+    except v3formats.FormatException as e:
+        sys.stderr.write(sys.argv[0] + ': ' + str(e) + '\n')
+        return False
+    print('\'' + name + '\':')
+    print('    Title: ' + map.mapName)
+    print('    VSP: ' + map.vspFilename)
+    print('    Music: ' + map.musicFilename)
+    print('    Size: ' + str(map.width) + 'x' + str(map.height))
+    print('    Start: ' + str(map.startX) + ', ' + str(map.startY) + ' (event: ' + map.startEvent + ')')
+    print('    Render order: ' + ','.join(map.renderOrder))
+    print('    Layers: ' + str(len(map.layer)))
+    for layer in map.layer:
+        print('        #' + str(layer.id) + ' \'' + layer.name + '\': ' + str(layer.width) + 'x' + str(layer.height)
+            + ', parallax ' + str(layer.parallaxX) + ', ' + str(layer.parallaxY) + ', opacity ' + str(layer.alpha))
+    print('    Zones: ' + str(len(map.zone)))
+    print('    Entities: ' + str(len(map.entity)))
+    for entity in map.entity:
+        print('        #' + str(entity.id) + ' \'' + entity.description + '\' at ' + str(entity.x) + ', ' + str(entity.y)
+            + ' (' + entity.filename + ')')
+    print('    Compressed sections:')
+    for sectionName, offset, uncompressedSize, compressedSize in map.sections:
+        print('        ' + sectionName + ' at offset ' + str(offset) + ': ' + str(compressedSize) + ' bytes (' + str(uncompressedSize) + ' uncompressed)')
+    return True
+
+JOB_FUNCTIONS = {
+    'map': convertMap,
+    'vsp': convertVSP,
+}
+
+def runJob(job, capture=True):
+    # Runs a single (kind, args) job for convertFiles. Returns (succeeded, output, errors).
+    # When capturing, the job's output is collected instead of printed, so that parallel jobs don't interleave.
+    kind, args = job
+    stdout, stderr = sys.stdout, sys.stderr
+    if capture:
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    try:
+        try:
+            print('')
+            succeeded = JOB_FUNCTIONS[kind](*args)
+        except Exception:
+            traceback.print_exc()
+            succeeded = False
+        if capture:
+            return succeeded, sys.stdout.getvalue(), sys.stderr.getvalue()
+        return succeeded, '', ''
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        
+def defaultJobCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def convertFiles(jobs, workers=1):
+    # Runs a list of (kind, args) jobs, spread across a pool of worker processes.
+    # Each job's output is printed all at once, in the order the jobs were given. Returns whether each job succeeded.
+    # No two jobs should write the same files (such as two maps that each dump the same VSP).
+    results = []
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            pending = pool.imap(runJob, jobs)
+            for i in range(len(jobs)):
+                while True:
+                    try:
+                        succeeded, output, errors = pending.next(JOB_POLL_TIMEOUT)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                sys.stderr.write(errors)
+                results.append(succeeded)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for job in jobs:
+            succeeded, output, errors = runJob(job, False)
+            results.append(succeeded)
+    return results
+    
+def getJobDependencies(job):
+    # The (inputs, outputs, options) of a job, as recorded in the manifest of an incremental run.
+    kind, args = job
+    if kind == 'map':
+        name, needVSP, encoding, extension, chunkSize, level = args
+        map = v3formats.Map()
+        map.loadMapHeader(name)
+        outputs = [os.path.splitext(name)[0] + extension, map.zoneDummyFilename]
+        if needVSP:
+            outputs += getJobDependencies(('vsp', (map.getVSPPath(),)))[1]
+        return [name, map.getVSPPath()], outputs, [encoding, extension, chunkSize, level, needVSP]
+    else:
+        name, = args
+        return [name], [name + v3formats.VSP_TILE_IMAGE_NAME, name + v3formats.VSP_OBS_IMAGE_NAME, name + '.anim'], []
+        
+def convertChangedFiles(jobs, workers, manifest):
+    # Like convertFiles, but skips any job the manifest says is up to date, and records each job that succeeds.
+    pending = []
+    for job in jobs:
+        key = manifest.getKey(job[0], job[1][0])
+        try:
+            dependencies = getJobDependencies(job)
+        except v3formats.FormatException:
+            # The job itself will report this.
+            dependencies = None
+        if dependencies is not None and manifest.isUpToDate(key, *dependencies):
+            manifest.skipped += 1
+        else:
+            pending.append((job, key, dependencies))
+    results = convertFiles([job for job, key, dependencies in pending], workers)
+    for (job, key, dependencies), succeeded in zip(pending, results):
+        if succeeded:
+            manifest.rebuilt += 1
+            if dependencies is not None:
+                manifest.update(key, *dependencies)
+    manifest.save()
+    return results
     
+def addVSPJob(jobs, seen, name):
+    # Each VSP gets converted at most once per run, no matter how many times it's asked for.
+    key = os.path.normcase(os.path.abspath(name))
+    if key not in seen:
+        seen.add(key)
+        jobs.append(('vsp', (name,)))
+
+if __name__ == '__main__':
     def main():
         count = 0
+        failed = 0
+        workers = defaultJobCount()
+        threads = None
+        jobs = []
+        seenVSPs = set()
         needVSP = False
-        compress = True
-        for i in range(1, len(sys.argv)):
-            arg = sys.argv[i]
+        manifestFilename = None
+        info = False
+        encoding = v3formats.TMX_ENCODING_ZLIB
+        extension = '.tmx'
+        chunkSize = 0
+        level = datastream.DEFAULT_COMPRESSION_LEVEL
+        args = iter(sys.argv[1:])
+        for arg in args:
             if arg.startswith('-'):
                 if arg ==  '-v':
                     needVSP = True
                 elif arg ==  '-raw':
-                    compress = False
+                    encoding = v3formats.TMX_ENCODING_XML
                 elif arg ==  '-z':
-                    compress = True
+                    encoding = v3formats.TMX_ENCODING_ZLIB
+                elif arg ==  '-gzip':
+                    encoding = v3formats.TMX_ENCODING_GZIP
+                elif arg ==  '-csv':
+                    encoding = v3formats.TMX_ENCODING_CSV
+                elif arg ==  '-json':
+                    extension = '.json'
+                elif arg ==  '-info' or arg == '--info':
+                    info = True
+                elif arg ==  '-i':
+                    manifestFilename = manifestFilename or manifest.MANIFEST_FILENAME
+                elif arg ==  '-manifest':
+                    try:
+                        manifestFilename = next(args)
+                    except StopIteration:
+                        sys.stderr.write(sys.argv[0] + ': option \'-manifest\' needs a filename.\n')
+                        sys.exit(-1)
+                elif arg ==  '-j':
+                    try:
+                        workers = int(next(args))
+                        if workers <= 0:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-j\' needs a positive number of jobs.\n')
+                        sys.exit(-1)
+                elif arg ==  '-level':
+                    try:
+                        level = int(next(args))
+                        if not 0 <= level <= 9:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-level\' needs a compression level from 0 to 9.\n')
+                        sys.exit(-1)
+                elif arg ==  '-threads':
+                    try:
+                        threads = int(next(args))
+                        if threads <= 0:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-threads\' needs a positive number of threads.\n')
+                        sys.exit(-1)
+                elif arg ==  '-chunk':
+                    try:
+                        chunkSize = int(next(args))
+                        if chunkSize <= 0:
+                            raise ValueError()
+                    except (StopIteration, ValueError):
+                        sys.stderr.write(sys.argv[0] + ': option \'-chunk\' needs a positive chunk size, e.g. -chunk ' + str(v3formats.TMX_DEFAULT_CHUNK_SIZE) + '.\n')
+                        sys.exit(-1)
                 else:
                     sys.stderr.write(sys.argv[0] + ': unknown option \'' + arg + '\'. run with no arguments to see usage.\n')
                     sys.exit(-1)
             else:
                 count += 1
-                print('')
                 if arg.lower().endswith('.map'):
-                    convertMap(arg, needVSP, compress)
+                    jobs.append(('map', (arg, needVSP, encoding, extension, chunkSize, level)))
                 elif arg.lower().endswith('.vsp'):
-                    convertVSP(arg)
+                    addVSPJob(jobs, seenVSPs, arg)
                 else:
                     sys.stderr.write(sys.argv[0] + ': file \'' + arg + '\' has an unsupported extension.\n')
+                    failed += 1
+        # -v applies to every map, no matter where it was given, so the maps' VSPs are only known once all the options are read.
+        # Each VSP is then converted by a job of its own, so that maps sharing a VSP don't both write its images.
+        if needVSP and not info:
+            for i, (kind, jobArgs) in enumerate(list(jobs)):
+                if kind == 'map':
+                    jobs[i] = (kind, (jobArgs[0], False) + jobArgs[2:])
+                    map = v3formats.Map()
+                    try:
+                        map.loadMapHeader(jobArgs[0])
+                    except v3formats.FormatException:
+                        # The map's own job will report this.
+                        continue
+                    addVSPJob(jobs, seenVSPs, map.getVSPPath())
+        # Several files at once already keeps every CPU busy, so by default each one only gets a single compression thread.
+        if threads is None and workers > 1 and len(jobs) > 1:
+            threads = 1
+        if threads is not None:
+            datastream.setCompressionThreads(threads)
+        if info:
+            # Just describe the maps. Nothing gets converted.
+            for kind, jobArgs in jobs:
+                print('')
+                if kind == 'map':
+                    failed += not printMapInfo(jobArgs[0])
+                else:
+                    sys.stderr.write(sys.argv[0] + ': --info only describes .map files, not \'' + jobArgs[0] + '\'.\n')
+                    failed += 1
+        elif manifestFilename:
+            manifestFile = manifest.Manifest(manifestFilename)
+            failed += convertChangedFiles(jobs, workers, manifestFile).count(False)
+            if count:
+                print('')
+                manifestFile.report()
+        else:
+            failed += convertFiles(jobs, workers).count(False)
         if count == 0:
             print('')
             sys.stderr.write(sys.argv[0] + ': no input files\n')
@@ -89,7 +331,27 @@ if __name__ == '__main__':
             print('')
             print('OPTIONS:')
             print('-v               convert the .vsp used by any map, like passed on commandline.')
+            print('--info           describe each .map (size, layers, entities, etc.) instead of')
+            print('                 converting it. This doesn\'t decompress any layers or load the .vsp.')
+            print('-j N             convert up to N files at once. (default: the number of CPUs)')
+            print('-threads N       compress each file\'s layers with N threads. (default: the number of')
+            print('                 CPUs when converting one file at a time, and 1 otherwise)')
+            print('-i               incremental: skip any file whose outputs are already up to date.')
+            print('                 what each output was built from is kept in \'' + manifest.MANIFEST_FILENAME + '\'.')
+            print('-manifest FILE   incremental, keeping the manifest in FILE instead.')
             print('-raw             use plain-text XML (no compression).')
             print('-z               (default) compress the .tmx map with zlib.')
+            print('-gzip            compress the .tmx map with gzip.')
+            print('-level N         compression level for -z and -gzip, from 1 (fastest)')
+            print('                 to 9 (smallest). 0 stores the data without compressing it.')
+            print('-csv             store the .tmx map\'s layers as comma-separated values.')
+            print('-json            export maps in Tiled\'s JSON map format (.json) instead of .tmx.')
+            print('                 layers are zlib compressed, or gzip compressed with -gzip.')
+            print('                 with -raw or -csv, they are plain arrays of numbers instead.')
+            print('-chunk N         split map layers into NxN chunks (an infinite map in tiled),')
+            print('                 leaving out any chunks that are completely empty.')
+            print('                 64 is a good size for large maps.')
+        if failed:
+            sys.exit(1)
     
     main()
\ No newline at end of file
@@ -0,0 +1,71 @@
+import itertools
+
+# How many elements repeatedElements() formats before handing them to the file.
+REPEATED_BATCH_SIZE = 4096
+
+def escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+def toText(v):
+    if isinstance(v, basestring):
+        return v
+    return str(v)
+
+def formatAttributes(attrs):
+    # Attributes are sorted by name, like minidom does.
+    return ''.join([' ' + name + '="' + escape(toText(attrs[name])) + '"' for name in sorted(attrs)])
+
+class XMLOutputStream(object):
+    # Writes an XML document to a file one element at a time, instead of building up a whole tree first.
+    # The layout matches what minidom's toprettyxml() produces, so documents come out the same as before.
+    def __init__ (self, file, indent='    '):
+        self.file = file
+        self.indent = indent
+        self.stack = []
+        # Whether the most recent start tag is still waiting on a '>' (or '/>' if it has no children).
+        self.pending = False
+        self.file.write('<?xml version="1.0" ?>\n')
+
+    def closePending(self):
+        if self.pending:
+            self.file.write('>\n')
+            self.pending = False
+
+    def start(self, tag, attrs={}):
+        self.closePending()
+        self.file.write(self.indent * len(self.stack) + '<' + tag + formatAttributes(attrs))
+        self.stack.append(tag)
+        self.pending = True
+
+    def end(self):
+        tag = self.stack.pop()
+        if self.pending:
+            self.file.write('/>\n')
+            self.pending = False
+        else:
+            self.file.write(self.indent * len(self.stack) + '</' + tag + '>\n')
+
+    def element(self, tag, attrs={}):
+        self.start(tag, attrs)
+        self.end()
+
+    def textElement(self, tag, attrs, text):
+        self.closePending()
+        self.file.write(self.indent * len(self.stack) + '<' + tag + formatAttributes(attrs) + '>' + escape(text) + '</' + tag + '>\n')
+
+    def repeatedElements(self, tag, attr, values):
+        # Many childless elements which differ only in the value of a single attribute, written a batch at a time.
+        # The values are written as-is, so this is meant for numbers.
+        self.closePending()
+        prefix = self.indent * len(self.stack) + '<' + tag + ' ' + attr + '="'
+        suffix = '"/>\n'
+        values = iter(values)
+        while True:
+            batch = [prefix + str(v) + suffix for v in itertools.islice(values, REPEATED_BATCH_SIZE)]
+            if not batch:
+                break
+            self.file.write(''.join(batch))
+
+    def close(self):
+        while self.stack:
+            self.end()